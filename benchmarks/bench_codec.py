@@ -0,0 +1,49 @@
+""" Compares size and speed of the binary encoding with the JSON encoding of blocks
+
+Run from the repository root with: python -m benchmarks.bench_codec
+"""
+
+import json
+import os
+from timeit import timeit
+
+from block import Block
+from transaction import Transaction
+from utils.codec import decode_block, encode_block
+
+ROUNDS = 200
+# Hex encoded DER public key of a 1024 bit RSA key has this many characters
+KEY_LENGTH = 324
+
+
+def make_block(transaction_count):
+    keys = [os.urandom(KEY_LENGTH // 2).hex() for _ in range(10)]
+    transactions = [Transaction(keys[i % 10], keys[(i + 1) % 10], os.urandom(128).hex(), i + 0.5)
+                    for i in range(transaction_count)]
+    transactions.append(Transaction('MINING', keys[0], '', 10))
+    return Block(1, os.urandom(32).hex(), transactions, 12345).to_dict()
+
+
+def run(transaction_count):
+    block = make_block(transaction_count)
+    json_data = json.dumps(block).encode()
+    binary_data = encode_block(block)
+    assert decode_block(binary_data) == json.loads(json_data)
+
+    json_encode = timeit(lambda: json.dumps(block).encode(),
+                         number=ROUNDS) / ROUNDS
+    json_decode = timeit(lambda: json.loads(json_data), number=ROUNDS) / ROUNDS
+    binary_encode = timeit(lambda: encode_block(block), number=ROUNDS) / ROUNDS
+    binary_decode = timeit(lambda: decode_block(
+        binary_data), number=ROUNDS) / ROUNDS
+
+    print(f'{transaction_count} transactions per block')
+    print(f'size:   json {len(json_data):9d} B   binary {len(binary_data):9d} B')
+    print(f'encode: json {json_encode * 1e6:9.1f} us  binary {binary_encode * 1e6:9.1f} us')
+    print(f'decode: json {json_decode * 1e6:9.1f} us  binary {binary_decode * 1e6:9.1f} us')
+
+
+if __name__ == '__main__':
+    for count in (0, 20, 200):
+        run(count)
+        print()
@@ -0,0 +1,172 @@
+""" Times the hot paths of a node on a synthetic chain and mempool and reports the results as JSON,
+so runs on different commits can be compared
+
+Run from the repository root with: python -m benchmarks.bench_suite [--output results.json]
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+from time import perf_counter, time
+
+from benchmarks.synthetic import MAX_AMOUNT, make_chain, make_transactions, make_wallets, write_store
+from blockchain import Blockchain
+from utils.hash_util import hash_block
+from utils.signature_cache import signature_cache
+from utils.verification import Verification
+from wallet import Wallet
+import web_node
+
+# Node id of the synthetic node
+NODE_ID = 9000
+
+
+def measure(function, rounds, items=1, setup=None):
+    """ Runs a function several times and returns the min, mean and max seconds per run
+
+    Arguments:
+        :function: The function to time
+        :rounds: The number of timed runs
+        :items: The number of operations one run performs, e.g. blocks hashed
+        :setup: Function called before every run, which isn't timed
+    """
+    timings = []
+    for _ in range(rounds):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        function()
+        timings.append(perf_counter() - start)
+    return {
+        'rounds': rounds,
+        'items': items,
+        'min': min(timings),
+        'mean': sum(timings) / rounds,
+        'max': max(timings),
+        'min_per_item': min(timings) / items
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    wallets = make_wallets(args.wallets)
+    chain = make_chain(wallets, args.blocks,
+                       args.transactions, args.seed)
+    open_transactions = make_transactions(wallets, args.mempool, rng)
+
+    # The block store of the synthetic node lives in a temporary directory
+    previous_directory = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='bench-')
+    os.chdir(directory)
+    try:
+        write_store(f'blockchain-{NODE_ID}', chain, open_transactions)
+        blockchain = Blockchain(
+            wallets[0].public_key, NODE_ID, args.workers)
+        results = {}
+
+        # Each round of the broadcast benchmark sends transactions which weren't seen before,
+        # from wallets which can afford them
+        funded = [wallet for wallet in wallets
+                  if blockchain.get_balance(wallet.public_key) >= args.rounds * args.transactions * MAX_AMOUNT]
+        if not funded:
+            raise ValueError('No wallet can afford the broadcast transactions, use more blocks')
+        incoming = make_transactions(
+            wallets, args.rounds * args.transactions, rng, funded)
+
+        template = list(blockchain.get_open_transactions())
+        tip_hash = blockchain.tip().hash
+        results['proof_of_work'] = measure(
+            lambda: blockchain.proof_of_work(template, tip_hash), args.rounds)
+        results['valid_proof'] = measure(
+            lambda: [Verification.valid_proof(block.transactions[:-1], block.previous_hash, block.proof)
+                     for block in chain[1:]], args.rounds, len(chain) - 1)
+        results['hash_block'] = measure(
+            lambda: [hash_block(block) for block in chain], args.rounds, len(chain))
+
+        # Cold runs verify every signature, warm runs find them in the signature cache
+        results['verify_chain_cold'] = measure(
+            lambda: Verification.verify_chain(chain, args.workers), args.rounds, len(chain), signature_cache.clear)
+        results['verify_chain_warm'] = measure(
+            lambda: Verification.verify_chain(chain, args.workers), args.rounds, len(chain))
+        results['verify_transaction_cold'] = measure(
+            lambda: [Wallet.verify_transaction(tx) for tx in open_transactions],
+            args.rounds, len(open_transactions), signature_cache.clear)
+        results['verify_transaction_warm'] = measure(
+            lambda: [Wallet.verify_transaction(tx) for tx in open_transactions], args.rounds, len(open_transactions))
+
+        results['get_balance'] = measure(
+            lambda: [blockchain.get_balance(wallet.public_key) for wallet in wallets], args.rounds, len(wallets))
+        results['save_data'] = measure(blockchain.save_data, args.rounds)
+        results['load_data'] = measure(blockchain.load_data, args.rounds)
+
+        web_node.wallet = wallets[0]
+        web_node.blockchain = blockchain
+        web_node.port = NODE_ID
+        web_node.mining_workers = args.workers
+        client = web_node.app.test_client()
+        results['flask_chain'] = measure(
+            lambda: client.get('/chain').get_data(), args.rounds, len(chain))
+
+        bodies = iter([tx.to_dict() for tx in incoming])
+
+        def post_transactions():
+            for _ in range(args.transactions):
+                response = client.post('/broadcast-transaction', json=next(bodies))
+                assert response.status_code == 201, response.get_json()
+
+        results['flask_broadcast_transaction'] = measure(
+            post_transactions, args.rounds, args.transactions)
+        blockchain.close()
+    finally:
+        os.chdir(previous_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'results': results
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--wallets', type=int, default=10,
+                        help='Number of RSA keys sending and receiving')
+    parser.add_argument('--blocks', type=int, default=50,
+                        help='Number of blocks after the genesis block')
+    parser.add_argument('--transactions', type=int, default=10,
+                        help='Number of transactions per block and per broadcast round')
+    parser.add_argument('--mempool', type=int, default=100,
+                        help='Number of open transactions')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Number of timed runs per benchmark')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used for mining and verifying')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='File to write the JSON results to (default: standard output)')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    report = json.dumps(run(args), indent=2)
+    if output is None:
+        print(report)
+    else:
+        with open(output, mode='w') as f:
+            f.write(report)
@@ -0,0 +1,65 @@
+""" Compares the per-nonce cost of the old and the prefix-hashing valid_proof
+
+Run from the repository root with: python -m benchmarks.bench_valid_proof
+"""
+
+from timeit import timeit
+
+from block import Block
+from transaction import Transaction
+from utils.hash_util import hash_block, hash_prefix_256, hash_string_256
+from utils.verification import Verification
+
+NONCES = 20000
+SENDER = '30819f300d06092a864886f70d010101050003818d0030818902818100' + 'ab' * 131
+
+
+def legacy_valid_proof(transactions, last_hash, proof):
+    """ The valid_proof implementation before the prefix hashing fast path """
+    guess = (str([tx.to_ordered_dict() for tx in transactions]) +
+             str(last_hash) + str(proof)).encode()
+    guess_hash = hash_string_256(guess)
+
+    return guess_hash[0: 2] == '00'
+
+
+def run(transaction_count=20):
+    transactions = [Transaction(SENDER, f'recipient-{i}', 'ab' * 64, i + 0.5)
+                    for i in range(transaction_count)]
+    last_hash = hash_block(Block(0, '', [], 100, 0))
+
+    # Both paths have to hash exactly the same bytes
+    guess_prefix = Verification.proof_prefix(transactions, last_hash)
+    for proof in range(1000):
+        legacy_guess = (str([tx.to_ordered_dict() for tx in transactions]) +
+                        str(last_hash) + str(proof)).encode()
+        fast_guess = hash_prefix_256(guess_prefix)
+        fast_guess.update(str(proof).encode())
+        assert hash_string_256(legacy_guess) == fast_guess.hexdigest()
+        assert legacy_valid_proof(transactions, last_hash, proof) == Verification.valid_proof(
+            transactions, last_hash, proof)
+
+    def legacy():
+        for proof in range(NONCES):
+            legacy_valid_proof(transactions, last_hash, proof)
+
+    def fast():
+        # What the miner does: serialize once, then only append the nonce
+        prefix_hash = hash_prefix_256(
+            Verification.proof_prefix(transactions, last_hash))
+        for proof in range(NONCES):
+            Verification.valid_guess(prefix_hash, proof)
+
+    legacy_time = timeit(legacy, number=1) / NONCES
+    fast_time = timeit(fast, number=1) / NONCES
+
+    print(f'{transaction_count} transactions per block')
+    print(f'legacy valid_proof: {legacy_time * 1e6:8.2f} us/nonce')
+    print(f'prefix valid_guess: {fast_time * 1e6:8.2f} us/nonce')
+    print(f'speedup:            {legacy_time / fast_time:8.1f}x')
+
+
+if __name__ == '__main__':
+    for count in (0, 20, 200):
+        run(count)
+        print()
@@ -0,0 +1,282 @@
+""" Mines, broadcasts transactions, changes the peers and reads from one node in several threads at once,
+then checks that the chain, the balances and the open transactions are still consistent
+
+Run from the repository root with: python -m benchmarks.stress [--seconds 10] [--output results.json]
+The exit code is 1 if a request failed unexpectedly or the node ended up inconsistent.
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from threading import Event, Lock, Thread
+from time import perf_counter, sleep
+
+from benchmarks.synthetic import MAX_AMOUNT, make_chain, make_transactions, make_wallets, write_store
+from blockchain import Blockchain
+from utils.hash_util import hash_transaction
+from utils.verification import Verification
+import web_node
+
+# Node id of the stressed node
+NODE_ID = 9100
+# Peer which refuses every connection, so broadcasts to it fail fast
+UNREACHABLE_PEER = '127.0.0.1:1'
+# Seconds the last mining job may take to finish once the threads are stopped
+JOB_TIMEOUT = 30
+# Number of errors listed in the report
+MAX_REPORTED_ERRORS = 20
+
+
+class Recorder:
+    """ Collects the latencies of the requests and the unexpected answers of all threads
+
+    Attributes:
+        :requests: The count, total and maximum seconds per endpoint
+        :errors: The first unexpected answers
+        :error_count: The number of unexpected answers
+    """
+
+    def __init__(self):
+        self.requests = {}
+        self.errors = []
+        self.error_count = 0
+        self.__lock = Lock()
+
+    def request(self, client, method, path, expected=(200,), route=None, **kwargs):
+        """ Sends a request and records its latency, unexpected status codes are recorded as errors.
+        Returns the response or None if the request raised.
+
+        Arguments:
+            :client: The Flask test client of the calling thread
+            :method: The HTTP method, e.g. 'get'
+            :path: The path including the query
+            :expected: The status codes which are fine
+            :route: The route the latency is recorded under (default: the path without the query)
+        """
+        name = f'{method.upper()} {route or path.split("?")[0]}'
+        start = perf_counter()
+        try:
+            response = getattr(client, method)(path, **kwargs)
+            response.get_data()
+        except Exception as error:
+            self.error(f'{name} raised {error!r}')
+            return None
+        elapsed = perf_counter() - start
+        with self.__lock:
+            count, total, maximum = self.requests.get(name, (0, 0.0, 0.0))
+            self.requests[name] = (count + 1, total + elapsed, max(maximum, elapsed))
+        if response.status_code not in expected:
+            self.error(f'{name} answered {response.status_code}: {response.get_data(as_text=True)[:200]}')
+        return response
+
+    def error(self, message):
+        with self.__lock:
+            self.error_count += 1
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append(message)
+
+    def report(self):
+        return {name: {'count': count, 'mean': total / count, 'max': maximum}
+                for name, (count, total, maximum) in sorted(self.requests.items())}
+
+
+def mine(recorder, stop, counts):
+    client = web_node.app.test_client()
+    while not stop.is_set():
+        response = recorder.request(client, 'post', '/mine', (202,))
+        if response is None or response.status_code != 202:
+            sleep(0.1)
+            continue
+        job_id = response.get_json()['job']['id']
+        # The last job is waited for, so the node is idle when it is checked
+        deadline = None
+        while True:
+            response = recorder.request(client, 'get', f'/mine/{job_id}', route='/mine/<job_id>')
+            if response is None or response.status_code != 200:
+                break
+            status = response.get_json()['job']['status']
+            if status in ('done', 'failed'):
+                counts[status] += 1
+                break
+            if stop.is_set():
+                deadline = deadline or perf_counter() + JOB_TIMEOUT
+                if perf_counter() > deadline:
+                    recorder.error(f'Mining job {job_id} is still {status}')
+                    break
+            sleep(0.01)
+
+
+def broadcast(recorder, stop, transactions):
+    client = web_node.app.test_client()
+    for tx in transactions:
+        if stop.is_set():
+            return
+        recorder.request(client, 'post', '/broadcast-transaction', (201,), json=tx.to_dict())
+
+
+def change_peers(recorder, stop):
+    client = web_node.app.test_client()
+    while not stop.is_set():
+        recorder.request(client, 'post', '/node', (201,), json={'node': UNREACHABLE_PEER})
+        sleep(0.02)
+        recorder.request(client, 'delete', f'/node/{UNREACHABLE_PEER}', route='/node/<node_url>')
+        sleep(0.02)
+
+
+def read(recorder, stop, public_keys):
+    client = web_node.app.test_client()
+    rng = random.Random()
+    while not stop.is_set():
+        response = recorder.request(client, 'get', '/chain')
+        if response is not None and response.status_code == 200:
+            # Every response has to be a consistent chain, even while blocks are added
+            blocks = response.get_json()
+            for previous, block in zip(blocks, blocks[1:]):
+                if block['index'] != previous['index'] + 1 or block['previous_hash'] != previous['hash']:
+                    recorder.error(f'GET /chain returned an inconsistent chain at block {block["index"]}')
+                    break
+        recorder.request(client, 'get', '/chain/tip')
+        recorder.request(client, 'get', '/balance')
+        recorder.request(client, 'get', '/transactions')
+        recorder.request(client, 'get', '/node')
+        recorder.request(client, 'get', f'/address/{rng.choice(public_keys)}/transactions?limit=5',
+                         route='/address/<address>/transactions')
+
+
+def check_consistency(blockchain, wallets):
+    """ Returns a dictionary of invariants of the node and whether they hold
+
+    Arguments:
+        :blockchain: The stressed blockchain
+        :wallets: The wallets taking part
+    """
+    chain = list(blockchain.chain)
+    confirmed = {}
+    confirmed_ids = set()
+    for block in chain:
+        for tx in block.transactions:
+            confirmed[tx.sender] = confirmed.get(tx.sender, 0) - tx.amount
+            confirmed[tx.recipient] = confirmed.get(tx.recipient, 0) + tx.amount
+            confirmed_ids.add(hash_transaction(tx))
+    open_transactions = blockchain.get_open_transactions()
+    pending = {}
+    for tx in open_transactions:
+        pending[tx.sender] = pending.get(tx.sender, 0) + tx.amount
+
+    def expected_balance(public_key):
+        return confirmed.get(public_key, 0) - pending.get(public_key, 0)
+
+    reloaded = Blockchain(wallets[0].public_key, NODE_ID, 1)
+    invariants = {
+        'chain_valid': Verification.verify_chain(chain, 1),
+        'balances_match_chain': all(abs(blockchain.get_balance(wallet.public_key) - expected_balance(wallet.public_key)) < 1e-6
+                                    for wallet in wallets),
+        'open_transactions_unconfirmed': not any(hash_transaction(tx) in confirmed_ids for tx in open_transactions),
+        'reload_same_tip': reloaded.height() == len(chain) and reloaded.tip().hash == chain[-1].hash,
+        'reload_same_balances': all(abs(reloaded.get_balance(wallet.public_key) - blockchain.get_balance(wallet.public_key)) < 1e-6
+                                    for wallet in wallets),
+        'reload_same_open_transactions': [hash_transaction(tx) for tx in reloaded.get_open_transactions()]
+        == [hash_transaction(tx) for tx in open_transactions]
+    }
+    reloaded.close()
+    return invariants
+
+
+def run(args):
+    # A stream apart from the synthetic chain's, which would replay its confirmed transactions
+    rng = random.Random(args.seed + 1)
+    wallets = make_wallets(args.wallets)
+    chain = make_chain(wallets, args.blocks, args.block_transactions, args.seed)
+
+    previous_directory = os.getcwd()
+    directory = tempfile.mkdtemp(prefix='stress-')
+    os.chdir(directory)
+    try:
+        write_store(f'blockchain-{NODE_ID}', chain)
+        blockchain = Blockchain(wallets[0].public_key, NODE_ID, args.workers)
+        web_node.wallet = wallets[0]
+        web_node.blockchain = blockchain
+        web_node.port = NODE_ID
+        web_node.mining_workers = args.workers
+
+        # Only wallets which can afford all of their transactions send, so every broadcast has to succeed
+        funded = [wallet for wallet in wallets
+                  if blockchain.get_balance(wallet.public_key) >= args.transactions * MAX_AMOUNT]
+        if not funded:
+            raise ValueError('No wallet can afford the broadcast transactions, use more blocks')
+        transactions = make_transactions(wallets, args.transactions, rng, funded)
+
+        recorder = Recorder()
+        stop = Event()
+        mining_counts = {'done': 0, 'failed': 0}
+        threads = [Thread(target=mine, args=(recorder, stop, mining_counts)),
+                   Thread(target=change_peers, args=(recorder, stop))]
+        threads.extend(Thread(target=broadcast, args=(recorder, stop, transactions[i::args.broadcasters]))
+                       for i in range(args.broadcasters))
+        threads.extend(Thread(target=read, args=(recorder, stop, [wallet.public_key for wallet in wallets]))
+                       for _ in range(args.readers))
+
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - start
+
+        invariants = check_consistency(blockchain, wallets)
+        blockchain.close()
+    finally:
+        os.chdir(previous_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'parameters': vars(args),
+        'seconds': elapsed,
+        'blocks_mined': mining_counts['done'],
+        'mining_jobs_failed': mining_counts['failed'],
+        'requests': recorder.report(),
+        'error_count': recorder.error_count,
+        'errors': recorder.errors,
+        'invariants': invariants,
+        'ok': recorder.error_count == 0 and all(invariants.values())
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=10,
+                        help='How long the threads run')
+    parser.add_argument('--wallets', type=int, default=8,
+                        help='Number of RSA keys sending and receiving')
+    parser.add_argument('--blocks', type=int, default=100,
+                        help='Number of blocks of the synthetic chain the node starts with')
+    parser.add_argument('--block-transactions', type=int, default=5,
+                        help='Number of transactions per block of the synthetic chain')
+    parser.add_argument('--transactions', type=int, default=300,
+                        help='Number of transactions broadcast to the node')
+    parser.add_argument('--broadcasters', type=int, default=4,
+                        help='Number of threads broadcasting transactions')
+    parser.add_argument('--readers', type=int, default=4,
+                        help='Number of threads reading the chain, balance, transactions and peers')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes used for mining')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='File to write the JSON results to (default: standard output)')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    result = run(args)
+    report = json.dumps(result, indent=2)
+    if output is None:
+        print(report)
+    else:
+        with open(output, mode='w') as f:
+            f.write(report)
+    sys.exit(0 if result['ok'] else 1)
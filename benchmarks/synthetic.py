@@ -0,0 +1,90 @@
+""" Generates synthetic chains and mempools with real RSA signed transactions for the benchmarks """
+
+import random
+
+from block import Block
+from blockchain import MINING_REWARD
+from mining import Miner
+from storage import BlockStore
+from transaction import Transaction
+from utils.merkle import merkle_root
+from utils.hash_util import hash_transaction
+from wallet import Wallet
+
+# Largest amount of a synthetic transaction
+MAX_AMOUNT = 0.1
+
+
+def make_wallets(count):
+    """ Creates wallets with fresh RSA keys, which are only kept in memory
+
+    Arguments:
+        :count: The number of wallets
+    """
+    wallets = []
+    for node_id in range(count):
+        wallet = Wallet(node_id)
+        wallet.create_keys()
+        wallets.append(wallet)
+    return wallets
+
+
+def make_transactions(wallets, count, rng, senders=None):
+    """ Creates signed transactions between random pairs of wallets.
+    Amounts are drawn at random, so transactions practically never share an id.
+
+    Arguments:
+        :wallets: The wallets sending and receiving
+        :count: The number of transactions
+        :rng: The random number generator picking the participants
+        :senders: The wallets which may send (default: all wallets)
+    """
+    transactions = []
+    for _ in range(count):
+        sender = rng.choice(wallets if senders is None else senders)
+        recipient = rng.choice([wallet for wallet in wallets if wallet is not sender])
+        amount = round(rng.uniform(0.01, MAX_AMOUNT), 6)
+        signature = sender.sign_transaction(
+            sender.public_key, recipient.public_key, amount)
+        transactions.append(Transaction(
+            sender.public_key, recipient.public_key, signature, amount))
+    return transactions
+
+
+def make_chain(wallets, block_count, transactions_per_block, seed=0):
+    """ Creates a valid chain starting with the genesis block of the Blockchain class.
+    The mining reward of every block goes to the next wallet, so all wallets have funds.
+
+    Arguments:
+        :wallets: The wallets mining and transacting
+        :block_count: The number of blocks after the genesis block
+        :transactions_per_block: The number of signed transactions in every block
+        :seed: The seed of the random choice of participants
+    """
+    rng = random.Random(seed)
+    miner = Miner(1)
+    chain = [Block(0, '', [], 100, 0)]
+    for index in range(1, block_count + 1):
+        transactions = make_transactions(wallets, transactions_per_block, rng)
+        proof = miner.mine(transactions, chain[-1].hash)
+        transactions.append(Transaction(
+            'MINING', wallets[index % len(wallets)].public_key, '', MINING_REWARD))
+        chain.append(Block(index, chain[-1].hash, transactions, proof,
+                           merkle_root=merkle_root([hash_transaction(tx) for tx in transactions])))
+    return chain
+
+
+def write_store(path, chain, open_transactions=()):
+    """ Writes a chain and its open transactions to a block store the way a node stores them
+
+    Arguments:
+        :path: The directory of the block store, e.g. 'blockchain-5000'
+        :chain: The blocks
+        :open_transactions: The transactions which aren't mined yet
+    """
+    store = BlockStore(path)
+    store.open(lambda block: Block.from_dict(block).hash)
+    for block in chain:
+        store.append_block(block.to_dict())
+    store.save_open_transactions([tx.to_dict() for tx in open_transactions])
+    store.close()
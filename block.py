@@ -1,12 +1,83 @@
 from time import time
 
+from transaction import Transaction
+from utils.hash_util import hash_block
 from utils.printable import Printable
 
 
 class Block(Printable):
-    def __init__(self, index, previous_hash, transactions, proof, timestamp=None):
-        self.index = index
-        self.previous_hash = previous_hash
-        self.timestamp = time() if timestamp is None else timestamp
-        self.transactions = transactions
-        self.proof = proof
+    """ A block of the blockchain, which can't be changed once it was created
+
+    Attributes:
+        :index: The position of the block in the chain
+        :previous_hash: The hash of the previous block
+        :timestamp: The time the block was created at
+        :transactions: The tuple of transactions in the block
+        :proof: The proof of work of the block
+        :hash: The hash of the block, computed once and cached
+        :merkle_root: The merkle root over the ids of the transactions (None for blocks mined before it existed)
+    """
+
+    __slots__ = ('index', 'previous_hash', 'timestamp',
+                 'transactions', 'proof', '_hash', 'merkle_root')
+
+    def __init__(self, index, previous_hash, transactions, proof, timestamp=None, hash=None, merkle_root=None):
+        initialise = super().__setattr__
+        initialise('index', index)
+        initialise('previous_hash', previous_hash)
+        initialise('timestamp', time() if timestamp is None else timestamp)
+        initialise('transactions', tuple(transactions))
+        initialise('proof', proof)
+        # A hash loaded from storage or received from a peer is trusted until the block is verified
+        initialise('_hash', hash)
+        initialise('merkle_root', merkle_root)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('A block can not be changed once it was created')
+
+    def __reduce__(self):
+        return (Block, (self.index, self.previous_hash, self.transactions, self.proof, self.timestamp, self._hash,
+                       self.merkle_root))
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            super().__setattr__('_hash', hash_block(self))
+        return self._hash
+
+    def verify_hash(self):
+        """ Recomputes the hash from the content of the block and checks it against the cached hash """
+        computed_hash = hash_block(self)
+        if self._hash is None:
+            super().__setattr__('_hash', computed_hash)
+        return self._hash == computed_hash
+
+    def to_dict(self):
+        """ Converts the block and its transactions to dictionaries which can be sent as JSON """
+        block_dict = {
+            'index': self.index,
+            'previous_hash': self.previous_hash,
+            'timestamp': self.timestamp,
+            'transactions': [tx.to_dict() for tx in self.transactions],
+            'proof': self.proof,
+            'hash': self.hash
+        }
+        if self.merkle_root is not None:
+            block_dict['merkle_root'] = self.merkle_root
+        return block_dict
+
+    @classmethod
+    def from_dict(cls, block):
+        """ Creates a block from its dictionary representation
+
+        Arguments:
+            :block: The dictionary, with or without the cached hash and merkle root
+        """
+        return cls(
+            block['index'],
+            block['previous_hash'],
+            [Transaction.from_dict(tx) for tx in block['transactions']],
+            block['proof'],
+            block['timestamp'],
+            block.get('hash'),
+            block.get('merkle_root'))
@@ -1,125 +1,285 @@
-from functools import reduce
-import json
+import os
+from threading import Lock, RLock
+
 import requests
 
-from utils.hash_util import hash_block, hash_string_256
+from utils.hash_util import hash_string_256, hash_transaction
+from utils.merkle import MerkleBuilder
 from utils.verification import Verification
+from utils.signature_cache import signature_cache
+from utils.codec import encode_block, encode_transaction
+from utils.metrics import metrics
 from block import Block
 from transaction import Transaction
+from ledger import BalanceLedger
+from mempool import Mempool
+from storage import BlockStore
+from chain import ChainView, LazyChain
+from tx_index import TransactionIndex
+from mining import Miner, MiningJobs
+from broadcast import BROADCAST_TIMEOUT, Broadcaster
+from peers import PeerManager
 from wallet import Wallet
 
 MINING_REWARD = 10
+# Number of block hashes requested first when looking for the common ancestor with a peer
+SYNC_FIRST_PAGE = 16
+# Maximum number of block hashes requested from a peer at once
+SYNC_MAX_PAGE = 500
+# Number of blocks after which a new snapshot of the balances is saved
+SNAPSHOT_INTERVAL = 100
+# Number of changes the journal of the open transactions may hold beyond twice the open transactions
+# before all open transactions are saved at once instead
+MEMPOOL_JOURNAL_SLACK = 1000
+
+# Latencies and outcomes of the main operations, exposed on /metrics
+PROOF_OF_WORK_SECONDS = metrics.histogram(
+    'blockchain_proof_of_work_seconds', 'Seconds spent searching for a proof of work')
+MINE_BLOCK_SECONDS = metrics.histogram(
+    'blockchain_mine_block_seconds', 'Seconds spent mining a block, including the broadcast')
+ADD_BLOCK_SECONDS = metrics.histogram(
+    'blockchain_add_block_seconds', 'Seconds spent verifying and adding a block received from a peer')
+RESOLVE_SECONDS = metrics.histogram(
+    'blockchain_resolve_seconds', 'Seconds spent resolving conflicts with the peer nodes')
+SAVE_SECONDS = metrics.histogram(
+    'blockchain_save_seconds', 'Seconds spent saving node data', ('part',))
+LOAD_SECONDS = metrics.histogram(
+    'blockchain_load_seconds', 'Seconds spent loading the node data')
+BLOCKS_TOTAL = metrics.counter(
+    'blockchain_blocks_total', 'Blocks mined by this node or received from peers', ('source', 'result'))
+CHAIN_REPLACEMENTS_TOTAL = metrics.counter(
+    'blockchain_chain_replacements_total', 'Times the chain was replaced by a longer chain of a peer')
 
 
 class Blockchain:
-    def __init__(self, public_key, node_id):
+    def __init__(self, public_key, node_id, mining_workers=None, peer_timeout=BROADCAST_TIMEOUT):
         # Initialising blockchain
-        genesis_block = Block(0, '', [], 100, 0)
-        self.chain = [genesis_block]
-        self.__open_transactions = []
-        self.__peer_nodes = set()
+        # One thread at a time changes the node, proof of work and network requests run outside the lock.
+        # Readers never take it, they see the append-only chain, mempool snapshots
+        # and the peer manager, which has a lock of its own
+        self.__lock = RLock()
+        # Only one resolve runs at a time, so the local blocks a downloaded fork builds on stay in place
+        self.__resolve_lock = Lock()
+        self.__mempool = Mempool()
+        # Failing peers are skipped for a while, so requests only go to peers which are likely to answer
+        self.peers = PeerManager()
+        self.__ledger = BalanceLedger()
         self.public_key = public_key
         self.node_id = node_id
+        self.__store = BlockStore(f'blockchain-{node_id}')
+        # Blocks are only read from the store when they are accessed
+        self.__chain = LazyChain(self.__store)
+        self.__tx_index = TransactionIndex(
+            os.path.join(self.__store.path, 'tx_index.jsonl'))
+        # Height of the last saved snapshot of the balances
+        self.__snapshot_height = 0
+        # Whether the changes of the open transactions since the last full save are all in the journal
+        self.__journal_complete = False
         self.resolve_conflicts = False
+        self.miner = Miner(mining_workers)
+        self.mining_jobs = MiningJobs(self.miner, self.mine_block)
+        self.broadcaster = Broadcaster(timeout=peer_timeout, on_result=self.peers.record)
         self.load_data()
 
     @property
     def chain(self):
-        return self.__chain[:]
+        """ A read-only view of the chain, blocks are only loaded when they are accessed """
+        return ChainView(self.__chain)
+
+    def tip(self):
+        """ Returns the last block of the chain """
+        return self.__chain[-1]
+
+    def height(self):
+        """ Returns the number of blocks in the chain """
+        return len(self.__chain)
 
-    @chain.setter
-    def chain(self, val):
-        self.__chain = val
+    def block_at(self, index):
+        """ Returns the block at the given index or None if there is no such block
+
+        Arguments:
+            :index: The index of the block
+        """
+        if not 0 <= index < len(self.__chain):
+            return None
+        return self.__chain[index]
 
     def get_open_transactions(self):
-        return self.__open_transactions[:]
+        """ Returns a read-only view of the open transactions in arrival order """
+        return self.__mempool.transactions()
+
+    def has_open_transaction(self, transaction):
+        """ Checks whether a transaction is open already.
+        Signatures are deterministic, so a second payment of the same amount from the same sender
+        to the same recipient is the same transaction and can't be added until the first one is mined.
 
+        Arguments:
+            :transaction: The transaction to look for
+        """
+        return hash_transaction(transaction) in self.__mempool
+
+    @LOAD_SECONDS.time()
     def load_data(self):
-        """ Loads the blockchain and open transactions from file """
+        """ Opens the block store and loads the open transactions and peer nodes.
 
-        try:
-            with open(f'blockchain-{self.node_id}.txt', mode='r') as f:
-                file_content = [json.loads(line.rstrip('\n'))
-                                for line in f.readlines()]
-
-                self.chain = [
-                    Block(
-                        block['index'],
-                        block['previous_hash'],
-                        [
-                            Transaction(
-                                tx['sender'],
-                                tx['recipient'],
-                                tx['signature'],
-                                tx['amount']
-                            )
-                            for tx in block['transactions']
-                        ],
-                        block['proof'],
-                        block['timestamp'])
-                    for block in file_content[0]
-                ]
-
-                self.__open_transactions = [
-                    Transaction(
-                        tx['sender'],
-                        tx['recipient'],
-                        tx['signature'],
-                        tx['amount']
-                    ) for tx in file_content[1]
-                ]
-
-                peer_nodes = file_content[2]
-                self.__peer_nodes = set(peer_nodes)
-        except (IOError, IndexError):
-            pass
+        The balances are restored from the latest snapshot and only the blocks appended after it
+        are read, so starting the node takes about the same time however long the chain is.
+        """
+
+        signature_cache.load(os.path.join(self.__store.path, 'verified.txt'))
+
+        with self.__lock:
+            try:
+                # The stored hashes are reused, so no block has to be hashed again
+                self.__store.open(lambda block: Block.from_dict(block).hash)
+                self.__store.migrate_legacy_file(f'blockchain-{self.node_id}.txt',
+                                                 lambda block: Block.from_dict(block).to_dict())
+                if not self.__chain:
+                    genesis_block = Block(0, '', [], 100, 0)
+                    self.__chain.append(genesis_block)
+
+                self.__mempool.clear()
+                transactions, changes = self.__store.load_open_transactions()
+                # Transactions which can't be stored in a block are dropped, e.g. ones accepted by older versions
+                for tx in map(Transaction.from_dict, transactions):
+                    if Verification.verify_fields(tx):
+                        self.__mempool.add(tx)
+                for change in changes:
+                    if change[0] == 'add':
+                        tx = Transaction.from_dict(change[1])
+                        if Verification.verify_fields(tx):
+                            self.__mempool.add(tx)
+                    elif change[0] == 'remove':
+                        self.__mempool.pop(change[1])
+                    else:
+                        self.__mempool.clear()
+                # The loaded transactions are saved already
+                self.__mempool.take_changes()
+                self.__journal_complete = True
+
+                self.peers.reset(self.__store.load_peer_nodes())
+
+                self.__load_balances()
+            except (IOError, IndexError, ValueError):
+                print('Loading failed')
+
+    def __load_balances(self):
+        snapshot = self.__store.load_snapshot()
+        # The balances are only read once all blocks are applied
+        with self.__ledger.batch():
+            self.__ledger.rebuild([], self.__mempool)
+            self.__snapshot_height = 0
+            try:
+                height = snapshot['height']
+                # A snapshot of blocks which were replaced since is ignored
+                if 0 < height <= len(self.__chain) and self.__chain.hash_at(height - 1) == snapshot['tip_hash']:
+                    self.__ledger.confirmed = dict(snapshot['balances'])
+                    self.__snapshot_height = height
+            except (KeyError, TypeError):
+                pass
+            for block in self.__chain.iter_blocks(self.__snapshot_height):
+                self.__ledger.apply_block(block)
+        if len(self.__chain) - self.__snapshot_height >= SNAPSHOT_INTERVAL:
+            self.save_snapshot()
+
+    def set_public_key(self, public_key):
+        """ Switches the wallet mining rewards go to and whose balance is returned by default,
+        e.g. after new keys were created. The chain, open transactions and peers stay as they are.
+
+        Arguments:
+            :public_key: The public key of the new wallet
+        """
+        with self.__lock:
+            self.public_key = public_key
+
+    def close(self):
+        """ Closes the block store, e.g. before another Blockchain is opened on the same store """
+        with self.__lock:
+            self.__store.close()
 
     def save_data(self):
-        """ Saves the blockchain and open transactions to a file """
+        """ Saves the transaction index, the open transactions and the peer nodes, blocks are stored as they are added """
+
+        with self.__lock:
+            self.save_chain()
+            self.save_open_transactions()
+            self.save_peer_nodes()
+
+    @SAVE_SECONDS.time('chain')
+    def save_chain(self):
+        """ Saves the transaction index and a new snapshot of the balances once enough blocks were added """
+
+        try:
+            self.__tx_index.save(self.__chain)
+        except IOError:
+            print('Saving failed')
+        if len(self.__chain) - self.__snapshot_height >= SNAPSHOT_INTERVAL:
+            self.save_snapshot()
+
+    @SAVE_SECONDS.time('snapshot')
+    def save_snapshot(self):
+        """ Saves the tip and the confirmed balances of every participant """
+
+        height = len(self.__chain)
+        try:
+            self.__store.save_snapshot({
+                'height': height,
+                'tip_hash': self.__chain.hash_at(height - 1),
+                'balances': dict(self.__ledger.confirmed)
+            })
+            self.__snapshot_height = height
+        except IOError:
+            print('Saving failed')
+
+    @SAVE_SECONDS.time('open_transactions')
+    def save_open_transactions(self):
+        """ Saves the open transactions and the ids of newly verified signatures to their own files.
+
+        Only the changes since the last save are appended to the journal of the open transactions,
+        all open transactions are written once the journal grows too long compared to them.
+        """
+
+        changes = self.__mempool.take_changes()
+        try:
+            if not self.__journal_complete or (self.__store.journal_length + len(changes)
+                                               > 2 * len(self.__mempool) + MEMPOOL_JOURNAL_SLACK):
+                self.__store.save_open_transactions(
+                    [tx.to_dict() for tx in self.__mempool])
+                self.__journal_complete = True
+            elif changes:
+                self.__store.append_open_transaction_changes(
+                    [['add', change[1].to_dict()] if change[0] == 'add' else list(change) for change in changes])
+        except IOError:
+            # The journal misses these changes, so everything is saved next time
+            self.__journal_complete = False
+            print('Saving failed')
+        signature_cache.save()
+
+    @SAVE_SECONDS.time('peer_nodes')
+    def save_peer_nodes(self):
+        """ Saves the peer nodes to their own file """
 
         try:
-            with open(f'blockchain-{self.node_id}.txt', mode='w') as f:
-                saveable_chain = [
-                    block.__dict__
-                    for block in
-                    [
-                        Block(
-                            block.index,
-                            block.previous_hash,
-                            [
-                                tx.__dict__ for tx in block.transactions],
-                            block.proof,
-                            block.timestamp
-                        ) for block in self.__chain
-                    ]
-                ]
-
-                f.write(json.dumps(saveable_chain))
-                f.write('\n')
-                saveable_transactions = [
-                    tx.__dict__ for tx in self.__open_transactions]
-                f.write(json.dumps(saveable_transactions))
-                f.write('\n')
-                f.write(json.dumps(list(self.__peer_nodes)))
+            self.__store.save_peer_nodes(self.peers.nodes())
         except IOError:
             print('Saving failed')
 
     def get_last_blockchain_value(self):
         """ Returns last value in the blockchain """
 
-        return self.__chain[-1]
-
-    def proof_of_work(self):
-        """ Calculates proof of work for mining a new block """
+        return self.tip()
 
-        last_block = self.get_last_blockchain_value()
-        last_hash = hash_block(last_block)
+    @PROOF_OF_WORK_SECONDS.time()
+    def proof_of_work(self, transactions, last_hash):
+        """ Calculates proof of work for mining a new block.
+        Returns None if mining was cancelled by a competing block.
 
-        proof = 0
-        while not Verification.valid_proof(self.__open_transactions, last_hash, proof):
-            proof += 1
+        Arguments:
+            :transactions: The transactions of the new block (without the reward)
+            :last_hash: The hash of the previous block
+        """
 
-        return proof
+        return self.miner.mine(transactions, last_hash)
 
     def get_balance(self, sender=None):
         """ Get the balance of a participant
@@ -135,26 +295,8 @@ class Blockchain:
         else:
             participant = sender
 
-        # Getting all the amounts sent by the participant
-        tx_sender = [[tx.amount for tx in block.transactions
-                      if tx.sender == participant] for block in self.__chain]
-        open_tx_sender = [tx.amount
-                          for tx in self.__open_transactions if tx.sender == participant]
-        tx_sender.append(open_tx_sender)
-
-        # Calculating the total amount sent
-        amount_sent = reduce(
-            lambda total, curr: total + sum(curr), tx_sender, 0)
-
-        # Getting all the amounts received by the participant
-        tx_recipient = [[tx.amount for tx in block.transactions
-                         if tx.recipient == participant] for block in self.__chain]
-
-        # Calculating the total amount received
-        amount_received = reduce(
-            lambda total, curr: total + sum(curr), tx_recipient, 0)
-
-        return amount_received - amount_sent
+        # The ledger already accounts for mined blocks and open transactions
+        return self.__ledger.balance(participant)
 
     def add_transaction(self, recipient, sender, signature, amount=1.0, is_receiving=False):
         """ Append a new transaction to the blockchain
@@ -170,137 +312,418 @@ class Blockchain:
 
         transaction = Transaction(sender, recipient, signature, amount)
 
-        if Verification.verify_transaction(transaction, self.get_balance):
-            self.__open_transactions.append(transaction)
-            self.save_data()
-            if not is_receiving:
-                for node in self.__peer_nodes:
-                    url = f'http://{node}/broadcast-transaction'
-                    try:
-                        response = requests.post(url, json={
-                            'sender': sender, 'recipient': recipient, 'amount': amount, 'signature': signature})
-                        if response.status_code == 400 or response.status_code == 500:
-                            print('Transaction declined')
-                            return False
-                    except requests.exceptions.ConnectionError:
-                        continue
+        # Resubmitted transactions are rejected before doing any verification
+        if hash_transaction(transaction) in self.__mempool:
+            return False
+
+        # The signature is checked before taking the lock, the check of the funds then finds it cached
+        if not Verification.verify_transaction(transaction, self.get_balance, check_funds=False):
+            return False
+
+        with self.__lock:
+            if not Verification.verify_transaction(transaction, self.get_balance):
+                return False
+            added, evicted = self.__mempool.add(transaction)
+            if not added:
+                return False
+            with self.__ledger.batch():
+                self.__ledger.add_pending(transaction)
+                for tx in evicted:
+                    self.__ledger.remove_pending(tx)
+            # A running mining job starts over so the new transaction makes it into its block
+            self.mining_jobs.restart()
+            self.save_open_transactions()
+
+        if not is_receiving:
+            # Unreachable peers are reported as None and skipped
+            statuses = self.broadcaster.post(self.peers.available(), '/broadcast-transaction', {
+                'sender': sender, 'recipient': recipient, 'amount': amount, 'signature': signature}, encode_transaction)
+            if any(status == 400 or status == 500 for status in statuses.values()):
+                print('Transaction declined')
+                return False
 
-            return True
-        return False
+        return True
+
+    def add_transactions(self, transactions, is_receiving=False):
+        """ Adds a batch of transactions at once.
+        The signatures are verified together, the funds of every sender are checked against one
+        balance snapshot minus what the sender spent earlier in the batch, the open transactions are
+        saved once and the accepted transactions are relayed to every peer in a single request.
+        Returns an (added, message) pair for every transaction.
 
+        Arguments:
+            :transactions: The transactions to add
+            :is_receiving: Whether the batch was relayed by a peer, so it isn't relayed again
+        """
+        results = [None] * len(transactions)
+        tx_ids = [hash_transaction(tx) for tx in transactions]
+        candidates = []
+        seen = set()
+        for position, tx_id in enumerate(tx_ids):
+            if tx_id in seen or tx_id in self.__mempool:
+                results[position] = (False, 'Duplicate transaction')
+            elif not Verification.verify_fields(transactions[position]):
+                results[position] = (False, 'Invalid transaction')
+            else:
+                seen.add(tx_id)
+                candidates.append(position)
+
+        # The signatures are checked before taking the lock
+        signatures_valid = Wallet.verify_transactions(
+            [transactions[position] for position in candidates])
+
+        accepted = []
+        evicted = []
+        with self.__lock:
+            balances = {}
+            for position, signature_valid in zip(candidates, signatures_valid):
+                tx = transactions[position]
+                if not signature_valid:
+                    results[position] = (False, 'Invalid signature')
+                    continue
+                if tx.sender not in balances:
+                    balances[tx.sender] = self.get_balance(tx.sender)
+                if balances[tx.sender] < tx.amount:
+                    results[position] = (False, 'Insufficient funds')
+                    continue
+                added, evicted_now = self.__mempool.add(tx)
+                if not added:
+                    results[position] = (False, 'Transaction failed')
+                    continue
+                balances[tx.sender] -= tx.amount
+                accepted.append(position)
+                evicted.extend(evicted_now)
+
+            # Transactions of the batch may already have been pushed out by later ones of it
+            evicted_ids = {hash_transaction(tx) for tx in evicted}
+            batch_ids = {tx_ids[position] for position in accepted}
+            with self.__ledger.batch():
+                for position in accepted:
+                    if tx_ids[position] in evicted_ids:
+                        results[position] = (False, 'Open transactions are full')
+                    else:
+                        self.__ledger.add_pending(transactions[position])
+                        results[position] = (True, 'Transaction added')
+                for tx in evicted:
+                    if hash_transaction(tx) not in batch_ids:
+                        self.__ledger.remove_pending(tx)
+            accepted = [position for position in accepted if results[position][0]]
+            if accepted:
+                # A running mining job starts over so the new transactions make it into its block
+                self.mining_jobs.restart()
+                self.save_open_transactions()
+
+        if accepted and not is_receiving:
+            statuses = self.broadcaster.post(self.peers.available(), '/broadcast-transaction/batch', {
+                'transactions': [transactions[position].to_dict() for position in accepted]})
+            if any(status == 400 or status == 500 for status in statuses.values()):
+                print('Transactions declined')
+
+        return results
+
+    @MINE_BLOCK_SECONDS.time()
     def mine_block(self):
         """ To mine a new block """
 
-        if self.public_key == None:
-            return None
+        # The tip and the template are taken together, so the template holds no transactions of the tip
+        with self.__lock:
+            # The reward goes to the wallet which was set when mining started
+            public_key = self.public_key
+            if public_key == None:
+                return None
+
+            last_block = self.tip()
 
-        last_block = self.get_last_blockchain_value()
+            # Get hash of last (previous) block
+            hashed_block = last_block.hash
 
-        # Get hash of last (previous) block
-        hashed_block = hash_block(last_block)
+            # Copying so that open transactions is not affected if something goes wrong
+            # and so transactions arriving while mining don't invalidate the proof
+            copied_transactions = self.__mempool.template()
+            # Only changes after taking the template cancel the search on it
+            self.miner.prepare()
 
-        # Calculate proof of work
-        proof = self.proof_of_work()
+        # Verifying all transactions in one batch
+        if not Verification.verify_transactions(copied_transactions, self.get_balance):
+            return None
+
+        # The merkle root is built up while the block is assembled, the reward is added last
+        merkle_builder = MerkleBuilder()
+        for tx in copied_transactions:
+            merkle_builder.add(hash_transaction(tx))
+
+        # Calculate proof of work, without holding the lock so the node keeps accepting transactions
+        proof = self.proof_of_work(copied_transactions, hashed_block)
 
         # Reward for mining
         reward_transaction = Transaction(
-            'MINING', self.public_key, '', MINING_REWARD)
+            'MINING', public_key, '', MINING_REWARD)
 
-        # Copying so that open transactions is not affected if something goes wrong
-        copied_transactions = self.__open_transactions[:]
-
-        # Verifying each transaction
-        for tx in copied_transactions:
-            if not Wallet.verify_transaction(tx):
-                return None
+        # Removing only the mined transactions, newer ones stay open
+        mined_transactions = copied_transactions[:]
 
         # Adding the reward transaction
         copied_transactions.append(reward_transaction)
+        merkle_builder.add(hash_transaction(reward_transaction))
 
-        # Creating the new block
-        block = Block(len(self.__chain), hashed_block,
-                      copied_transactions, proof)
-
-        # Adding the block to the chain
-        self.__chain.append(block)
-        self.__open_transactions = []
-        self.save_data()
+        with self.__lock:
+            # Mining was cancelled or another block was added in the meantime
+            if proof is None or self.__chain.hash_at(len(self.__chain) - 1) != hashed_block:
+                BLOCKS_TOTAL.inc('mined', 'cancelled')
+                return None
 
-        for node in self.__peer_nodes:
-            url = f'http://{node}/broadcast-block'
-            converted_block = block.__dict__.copy()
-            converted_block['transactions'] = [tx.__dict__.copy()
-                                               for tx in converted_block['transactions']]
+            # Creating the new block
+            block = Block(len(self.__chain), hashed_block,
+                          copied_transactions, proof, merkle_root=merkle_builder.root())
 
+            # Adding the block to the chain, which writes it to the store
             try:
-                response = requests.post(url, json={'block': converted_block})
-                if response.status_code == 400 or response.status_code == 500:
-                    print('Block declined')
-                if response.status_code == 409:
-                    self.resolve_conflicts = True
-            except requests.exceptions.ConnectionError:
-                continue
-
+                self.__chain.append(block)
+            except (IOError, ValueError):
+                print('Saving failed')
+                return None
+            with self.__ledger.batch():
+                self.__ledger.apply_block(block)
+                for tx in mined_transactions:
+                    if self.__mempool.remove(tx) is not None:
+                        self.__ledger.remove_pending(tx)
+            self.__tx_index.apply_block(block)
+            self.save_chain()
+            self.save_open_transactions()
+
+        statuses = self.broadcaster.post(
+            self.peers.available(), '/broadcast-block', {'block': block.to_dict()},
+            lambda payload: encode_block(payload['block']))
+        for status in statuses.values():
+            if status == 400 or status == 500:
+                print('Block declined')
+            if status == 409:
+                self.resolve_conflicts = True
+
+        BLOCKS_TOTAL.inc('mined', 'accepted')
         return block
 
+    @ADD_BLOCK_SECONDS.time()
     def add_block(self, block):
-        transactions = [Transaction(
-            tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']]
+        converted_block = Block.from_dict(block)
+        previous_block = self.tip()
 
-        # We shouldn't pass in the last transaction, i.e., the minig reward to verify proof of work
-        proof_is_valid = Verification.valid_proof(
-            transactions[:-1], block['previous_hash'], block['proof'])
+        # Checks the hashes, the proof of work and the signatures,
+        # which are usually cached already since the transactions were broadcast before
+        if not Verification.verify_block(converted_block, previous_block):
+            BLOCKS_TOTAL.inc('received', 'rejected')
+            return False
 
-        hashes_match = hash_block(self.chain[-1]) == block['previous_hash']
+        with self.__lock:
+            # Another block may have been added while this one was verified
+            if self.__chain.hash_at(len(self.__chain) - 1) != previous_block.hash:
+                BLOCKS_TOTAL.inc('received', 'rejected')
+                return False
+            try:
+                self.__chain.append(converted_block)
+            except (IOError, ValueError):
+                print('Saving failed')
+                return False
+            # Our own proof of work would build on an outdated block now
+            self.mining_jobs.restart()
+            with self.__ledger.batch():
+                self.__ledger.apply_block(converted_block)
+                # Confirmed transactions leave the open transactions
+                for tx in converted_block.transactions:
+                    removed = self.__mempool.remove(tx)
+                    if removed is not None:
+                        self.__ledger.remove_pending(removed)
+            self.__tx_index.apply_block(converted_block)
+
+            self.save_chain()
+            self.save_open_transactions()
+        BLOCKS_TOTAL.inc('received', 'accepted')
+        return True
 
-        if not proof_is_valid or not hashes_match:
-            return False
+    def get_blocks(self, start, limit):
+        """ Returns a range of blocks of the chain
+
+        Arguments:
+            :start: The index of the first block
+            :limit: The maximum number of blocks
+        """
+        return self.__chain[start:start + limit]
+
+    def iter_blocks(self, start=0, limit=None):
+        """ Yields a range of blocks one at a time without copying the chain or loading it at once
 
-        converted_block = Block(
-            block['index'], block['previous_hash'], transactions, block['proof'], block['timestamp'])
-        self.__chain.append(converted_block)
-        stored_transactions = self.__open_transactions[:]
-        for itx in block['transactions']:
-            for opentx in stored_transactions:
-                if opentx.sender == itx['sender'] and opentx.recipient == itx['recipient'] and opentx.amount == itx['amount'] and opentx.signature == itx['signature']:
+        Arguments:
+            :start: The index of the first block
+            :limit: The maximum number of blocks (default: up to the tip)
+        """
+        end = None if limit is None else start + limit
+        return self.__chain.iter_blocks(start, end)
+
+    def get_transaction(self, tx_id):
+        """ Returns a transaction with the index of its block and its position in it,
+        (transaction, None, None) if it is still open or None if it is unknown.
+
+        Arguments:
+            :tx_id: The id of the transaction (see hash_transaction)
+        """
+        location = self.__transaction_index().locate(tx_id)
+        if location is not None:
+            block_index, position = location
+            return self.__chain[block_index].transactions[position], block_index, position
+        transaction = self.__mempool.get(tx_id)
+        if transaction is not None:
+            return transaction, None, None
+        return None
+
+    def get_address_transactions(self, address, start, limit):
+        """ Returns a page of the confirmed transactions an address sent or received, oldest first,
+        each with the index of its block and its position in it, and the total number of them.
+
+        Arguments:
+            :address: The public key of the participant
+            :start: The number of transactions to skip
+            :limit: The maximum number of transactions
+        """
+        tx_index = self.__transaction_index()
+        transactions = [(self.__chain[block_index].transactions[position], block_index, position)
+                        for block_index, position in tx_index.address_references(address, start, limit)]
+        return transactions, tx_index.address_count(address)
+
+    def __transaction_index(self):
+        # The index is loaded when it is first used instead of when the node starts
+        if not self.__tx_index.loaded:
+            with self.__lock:
+                if not self.__tx_index.loaded:
                     try:
-                        self.__open_transactions.remove(opentx)
-                    except ValueError:
-                        print('Transaction already removed')
+                        self.__tx_index.load(self.__chain)
+                        self.__tx_index.save(self.__chain)
+                    except IOError:
+                        print('Indexing failed')
+        return self.__tx_index
 
-        self.save_data()
-        return True
+    def get_block_hashes(self, start, limit):
+        """ Returns the hashes of a range of blocks of the chain
+
+        Arguments:
+            :start: The index of the first block
+            :limit: The maximum number of hashes
+        """
+        return self.__chain.hashes(start, limit)
+
+    def find_common_ancestor(self, node, chain, node_length):
+        """ Returns the index of the last block a peer shares with the given chain,
+        or -1 if not even the genesis blocks match.
 
+        The hashes of the peer are requested in pages which double in size
+        while walking back from the tip, so the cost depends on how far the chains diverged.
+
+        Arguments:
+            :node: The peer node URL
+            :chain: The chain to compare against
+            :node_length: The number of blocks of the peer's chain
+        """
+        end = min(len(chain), node_length)
+        page_size = SYNC_FIRST_PAGE
+        while end > 0:
+            start = max(0, end - page_size)
+            node_hashes = self.broadcaster.fetch(
+                node, '/chain/hashes', {'from': start, 'limit': end - start})
+            for index in range(min(end, start + len(node_hashes)) - 1, start - 1, -1):
+                if node_hashes[index - start] == chain.hash_at(index):
+                    return index
+            end = start
+            page_size = min(page_size * 2, SYNC_MAX_PAGE)
+        return -1
+
+    def download_blocks(self, node, start, end):
+        """ Downloads the blocks of a peer from start up to (excluding) end,
+        converting them one at a time as they are streamed in
+
+        Arguments:
+            :node: The peer node URL
+            :start: The index of the first block
+            :end: The number of blocks of the peer's chain
+        """
+        # The hashes sent along are checked when the blocks are verified
+        return [Block.from_dict(block)
+                for block in self.broadcaster.stream_blocks(node, '/chain', {'from': start, 'limit': end - start, 'format': 'ndjson'})]
+
+    @RESOLVE_SECONDS.time()
     def resolve(self):
-        winner_chain = self.chain
+        """ Replaces the chain with the longest valid chain of the peer nodes.
+
+        Only the blocks after the common ancestor are downloaded and verified.
+        """
+        with self.__resolve_lock:
+            return self.__resolve()
+
+    def __resolve(self):
+        # The longest valid chain found so far, peer chains only hold the blocks after the fork in memory
+        winner_chain = self.__chain
         replace = False
-        for node in self.__peer_nodes:
-            url = f'http://{node}/chain'
+        for node in self.peers.available():
             try:
-                response = requests.get(url)
-                node_chain = response.json()
-                node_chain = [Block(block['index'], block['previous_hash'], block['transactions'],
-                                    block['proof'], block['timestamp']) for block in node_chain]
-                for block in node_chain:
-                    block.transactions = [Transaction(
-                        tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block.transactions]
-
-                node_chain_length = len(node_chain)
-                winner_chain_length = len(winner_chain)
-
-                if node_chain_length > winner_chain_length and Verification.verify_chain(node_chain):
-                    winner_chain = node_chain
+                tip = self.broadcaster.fetch(node, '/chain/tip')
+                node_chain_length = tip['index'] + 1
+
+                if node_chain_length <= len(winner_chain):
+                    continue
+
+                ancestor = self.find_common_ancestor(
+                    node, winner_chain, node_chain_length)
+                suffix = self.download_blocks(
+                    node, ancestor + 1, node_chain_length)
+
+                if ancestor + 1 + len(suffix) <= len(winner_chain):
+                    continue
+
+                # The blocks up to the ancestor were verified before
+                verify_from = max(ancestor, 0)
+                invalid_height = Verification.find_invalid_block(
+                    winner_chain[verify_from:ancestor + 1] + suffix)
+                if invalid_height is None:
+                    winner_chain = winner_chain.fork(ancestor + 1, suffix)
                     replace = True
+                else:
+                    print(
+                        f'Chain of {node} is invalid from height {verify_from + invalid_height}')
 
-            except requests.exceptions.ConnectionError:
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError, TimeoutError):
                 continue
 
         self.resolve_conflicts = False
-        self.chain = winner_chain
-        if replace:
-            self.__open_transactions = []
-        self.save_data()
-        return replace
+        if not replace:
+            return False
+
+        with self.__lock:
+            # Blocks mined or received during the download only ever extend the local chain,
+            # so the blocks before the fork are still the ones which were verified
+            if len(winner_chain) <= len(self.__chain):
+                return False
+            self.mining_jobs.restart()
+            # Only the blocks after the common ancestor are rolled back and rewritten
+            shared = winner_chain.start
+            with self.__ledger.batch():
+                for block in reversed(self.__chain[shared:]):
+                    self.__ledger.revert_block(block)
+                self.__tx_index.truncate(shared)
+                try:
+                    self.__chain.truncate(shared)
+                    for block in winner_chain.blocks:
+                        self.__chain.append(block)
+                        self.__ledger.apply_block(block)
+                        self.__tx_index.apply_block(block)
+                except (IOError, ValueError):
+                    print('Saving failed')
+                self.__mempool.clear()
+                self.__ledger.clear_pending()
+            # The last snapshot may contain blocks which were rolled back
+            if shared < self.__snapshot_height:
+                self.save_snapshot()
+            self.save_chain()
+            self.save_open_transactions()
+        CHAIN_REPLACEMENTS_TOTAL.inc()
+        return True
 
     def add_peer_node(self, node):
         """ Adds a new node to the peer node set.
@@ -308,8 +731,9 @@ class Blockchain:
         Arguments:
             :node: The node URL which should be added.
         """
-        self.__peer_nodes.add(node)
-        self.save_data()
+        with self.__lock:
+            self.peers.add(node)
+            self.save_peer_nodes()
 
     def remove_peer_node(self, node):
         """ Removes a node from the peer node set.
@@ -317,9 +741,11 @@ class Blockchain:
         Arguments:
             :node: The node URL which should be removed.
         """
-        self.__peer_nodes.discard(node)
-        self.save_data()
+        with self.__lock:
+            self.peers.remove(node)
+            self.save_peer_nodes()
+        self.broadcaster.forget(node)
 
     def get_peer_nodes(self):
-        """ Return list of all connected peer nodes """
-        return list(self.__peer_nodes)
+        """ Return list of all connected peer nodes, including the ones which are currently skipped """
+        return self.peers.nodes()
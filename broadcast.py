@@ -0,0 +1,184 @@
+""" Provides concurrent broadcasting of transactions and blocks to the peer nodes """
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+from threading import Lock
+from time import perf_counter
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.codec import CONTENT_TYPE, decode_block, iter_frames
+from utils.metrics import metrics
+
+# Maximum number of peers posted to at the same time
+BROADCAST_WORKERS = 16
+# (connect, read) timeout in seconds of a single request to a peer
+BROADCAST_TIMEOUT = (3.05, 10)
+# Number of bytes read at once from a streamed response
+STREAM_CHUNK_SIZE = 64 * 1024
+# Maximum number of seconds a streamed download may take, so a peer trickling data can't stall the node
+STREAM_TIMEOUT = 120
+
+# Latencies and outcomes of the broadcasts, exposed on /metrics
+BROADCAST_SECONDS = metrics.histogram(
+    'broadcast_seconds', 'Seconds until all peers answered a broadcast', ('path',))
+BROADCAST_REQUEST_SECONDS = metrics.histogram(
+    'broadcast_request_seconds', 'Seconds a single peer took to answer a broadcast', ('path',))
+BROADCAST_REQUESTS_TOTAL = metrics.counter(
+    'broadcast_requests_total', 'Broadcast requests to peers by status code', ('path', 'status'))
+
+
+class Broadcaster:
+    """ Posts to all peer nodes at once through a bounded thread pool,
+    reusing one keep-alive connection pool per peer.
+
+    Attributes:
+        :timeout: The (connect, read) timeout of a single request
+        :stream_timeout: The maximum number of seconds a streamed download may take
+        :on_result: Function called with the node, the seconds and the exception (None on success)
+                    of every request, e.g. to track the health of the peers
+    """
+
+    def __init__(self, workers=BROADCAST_WORKERS, timeout=BROADCAST_TIMEOUT, stream_timeout=STREAM_TIMEOUT,
+                 on_result=None):
+        self.timeout = timeout
+        self.stream_timeout = stream_timeout
+        self.on_result = on_result
+        self.__executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='broadcast')
+        self.__sessions = {}
+        self.__json_only = set()
+        self.__lock = Lock()
+
+    def __session(self, node):
+        with self.__lock:
+            session = self.__sessions.get(node)
+            if session is None:
+                session = requests.Session()
+                session.mount('http://', HTTPAdapter(pool_connections=1,
+                                                     pool_maxsize=BROADCAST_WORKERS))
+                self.__sessions[node] = session
+            return session
+
+    def __report(self, node, start, error=None):
+        if self.on_result is not None:
+            self.on_result(node, perf_counter() - start, error)
+
+    def __post(self, node, path, payload, binary_payload):
+        start = perf_counter()
+        try:
+            status = self.__send(node, path, payload, binary_payload)
+            error = None
+        except requests.exceptions.RequestException as exception:
+            status, error = None, exception
+        BROADCAST_REQUEST_SECONDS.observe(perf_counter() - start, path)
+        BROADCAST_REQUESTS_TOTAL.inc(path, 'unreachable' if status is None else str(status))
+        self.__report(node, start, error)
+        return status
+
+    def __send(self, node, path, payload, binary_payload):
+        session = self.__session(node)
+        if binary_payload is not None and node not in self.__json_only:
+            response = session.post(f'http://{node}{path}', data=binary_payload, timeout=self.timeout,
+                                    headers={'Content-Type': CONTENT_TYPE})
+            if response.status_code != 415:
+                return response.status_code
+            # The peer doesn't understand the binary encoding, so JSON is used from now on
+            self.__json_only.add(node)
+        response = session.post(
+            f'http://{node}{path}', json=payload, timeout=self.timeout)
+        return response.status_code
+
+    def post(self, nodes, path, payload, encode=None):
+        """ Posts the payload to all nodes concurrently.
+        Returns the status code per node, None for nodes which couldn't be reached in time.
+
+        Arguments:
+            :nodes: The peer nodes to post to
+            :path: The path of the endpoint, e.g. '/broadcast-block'
+            :payload: The JSON body of the request
+            :encode: Function encoding the payload to the binary format, peers which
+                     don't support it get the JSON body instead
+        """
+        binary_payload = None
+        if encode is not None:
+            try:
+                binary_payload = encode(payload)
+            except ValueError:
+                pass
+
+        nodes = list(nodes)
+        if not nodes:
+            return {}
+        with BROADCAST_SECONDS.time(path):
+            futures = [self.__executor.submit(self.__post, node, path, payload, binary_payload)
+                       for node in nodes]
+            return {node: future.result() for node, future in zip(nodes, futures)}
+
+    def fetch(self, node, path, params=None):
+        """ Sends a GET request to a single node over its keep-alive session and returns the JSON body.
+        Raises a requests exception if the node can't be reached or doesn't answer with 200.
+
+        Arguments:
+            :node: The node URL
+            :path: The path of the endpoint, e.g. '/chain/tip'
+            :params: The query parameters
+        """
+        start = perf_counter()
+        try:
+            response = self.__session(node).get(
+                f'http://{node}{path}', params=params, timeout=self.timeout)
+            response.raise_for_status()
+            body = response.json()
+        except (requests.exceptions.RequestException, ValueError) as error:
+            self.__report(node, start, error)
+            raise
+        self.__report(node, start)
+        return body
+
+    def stream_blocks(self, node, path, params=None):
+        """ Sends a GET request to a single node for a stream of blocks
+        and yields their dictionaries as they arrive.
+
+        The binary encoding is asked for first, nodes which don't support it answer with NDJSON.
+        A download taking longer than stream_timeout raises a Timeout.
+
+        Arguments:
+            :node: The node URL
+            :path: The path of the endpoint, e.g. '/chain'
+            :params: The query parameters
+        """
+        start = perf_counter()
+        headers = {'Accept': f'{CONTENT_TYPE}, application/x-ndjson'}
+        try:
+            with self.__session(node).get(f'http://{node}{path}', params=params, headers=headers,
+                                          timeout=self.timeout, stream=True) as response:
+                response.raise_for_status()
+                if response.headers.get('Content-Type', '').startswith(CONTENT_TYPE):
+                    blocks = (decode_block(frame)
+                              for frame in iter_frames(response.iter_content(STREAM_CHUNK_SIZE)))
+                else:
+                    blocks = (json.loads(line) for line in response.iter_lines() if line)
+                for block in blocks:
+                    # The read timeout only covers the gaps between chunks
+                    if perf_counter() - start > self.stream_timeout:
+                        raise requests.exceptions.Timeout(
+                            f'Downloading from {node} took more than {self.stream_timeout} seconds')
+                    yield block
+        except (requests.exceptions.RequestException, ValueError) as error:
+            self.__report(node, start, error)
+            raise
+        self.__report(node, start)
+
+    def forget(self, node):
+        """ Closes the connections to a node which is no longer a peer
+
+        Arguments:
+            :node: The node URL
+        """
+        with self.__lock:
+            session = self.__sessions.pop(node, None)
+            self.__json_only.discard(node)
+        if session is not None:
+            session.close()
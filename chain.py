@@ -0,0 +1,198 @@
+""" Provides a chain of blocks which are loaded from the block store when they are accessed """
+
+from collections import OrderedDict
+from threading import Lock
+
+from block import Block
+
+# Number of decoded blocks kept in memory
+BLOCK_CACHE_SIZE = 2048
+
+
+class LazyChain:
+    """ The blocks of the chain, backed by the block store.
+
+    Blocks are only read and decoded when they are accessed and the most recently used
+    ones are cached. Appending or truncating the chain writes through to the store.
+
+    Arguments:
+        :store: The opened block store
+        :cache_size: The maximum number of decoded blocks kept in memory
+    """
+
+    def __init__(self, store, cache_size=BLOCK_CACHE_SIZE):
+        self.__store = store
+        self.__cache_size = cache_size
+        self.__cache = OrderedDict()
+        # Counts the truncations, a block read before one of them must not be cached afterwards
+        self.__truncations = 0
+        self.__lock = Lock()
+
+    def __len__(self):
+        return self.__store.height
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.__block(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Block index out of range')
+        return self.__block(index)
+
+    def __iter__(self):
+        return self.iter_blocks()
+
+    def __block(self, index, cache=True):
+        with self.__lock:
+            block = self.__cache.get(index)
+            if block is not None:
+                self.__cache.move_to_end(index)
+                return block
+            truncations = self.__truncations
+        block = Block.from_dict(self.__store.read_block(index))
+        if cache:
+            with self.__lock:
+                if truncations != self.__truncations:
+                    return block
+                self.__cache[index] = block
+                if len(self.__cache) > self.__cache_size:
+                    self.__cache.popitem(last=False)
+        return block
+
+    def iter_blocks(self, start=0, end=None):
+        """ Yields a range of blocks one at a time, blocks which aren't cached yet
+        are not added to the cache so a full scan doesn't evict the recently used blocks.
+        The iteration ends early once the chain is truncated, e.g. when it's replaced by a fork,
+        so the yielded blocks always belong to the chain as it was when the iteration started.
+
+        Arguments:
+            :start: The index of the first block
+            :end: The index after the last block (default: up to the tip)
+        """
+        with self.__lock:
+            truncations = self.__truncations
+        end = len(self) if end is None else min(end, len(self))
+        for index in range(start, end):
+            try:
+                block = self.__block(index, cache=False)
+            except (IndexError, ValueError):
+                # The block was cut off while it was read
+                return
+            # The block may already belong to the fork replacing the chain
+            if self.__truncations != truncations:
+                return
+            yield block
+
+    def hash_at(self, index):
+        """ Returns the hash of a block without loading the block
+
+        Arguments:
+            :index: The index of the block
+        """
+        return self.__store.hash_at(index)
+
+    def hashes(self, start, limit):
+        """ Returns the hashes of a range of blocks without loading the blocks
+
+        Arguments:
+            :start: The index of the first block
+            :limit: The maximum number of hashes
+        """
+        return self.__store.hashes(start, limit)
+
+    def append(self, block):
+        """ Appends a block and writes it to the store
+
+        Arguments:
+            :block: The block to append
+        """
+        self.__store.append_block(block.to_dict())
+        with self.__lock:
+            self.__cache[block.index] = block
+            if len(self.__cache) > self.__cache_size:
+                self.__cache.popitem(last=False)
+
+    def truncate(self, height):
+        """ Removes all blocks from the given height onwards, from the store as well
+
+        Arguments:
+            :height: The number of blocks which should be kept
+        """
+        with self.__lock:
+            self.__store.truncate(height)
+            self.__truncations += 1
+            for index in [index for index in self.__cache if index >= height]:
+                del self.__cache[index]
+
+    def fork(self, start, blocks):
+        """ Returns a chain sharing the blocks before start with this one, continued by other blocks
+
+        Arguments:
+            :start: The index of the first block which differs
+            :blocks: The blocks from start onwards
+        """
+        return ChainFork(self, start, list(blocks))
+
+
+class ChainView:
+    """ A read-only view of a chain, which can be indexed, sliced and iterated without copying the chain.
+    Slicing returns a list of just the selected blocks.
+
+    Arguments:
+        :chain: The chain to look at
+    """
+
+    __slots__ = ('__chain',)
+
+    def __init__(self, chain):
+        self.__chain = chain
+
+    def __len__(self):
+        return len(self.__chain)
+
+    def __getitem__(self, index):
+        return self.__chain[index]
+
+    def __iter__(self):
+        return self.__chain.iter_blocks()
+
+    def hash_at(self, index):
+        return self.__chain.hash_at(index)
+
+
+class ChainFork:
+    """ A candidate chain, e.g. downloaded from a peer, which shares the blocks before start
+    with the local chain and continues with its own blocks, which are kept in memory.
+
+    Attributes:
+        :chain: The local chain
+        :start: The index of the first block which differs from the local chain
+        :blocks: The blocks from start onwards
+    """
+
+    def __init__(self, chain, start, blocks):
+        self.chain = chain
+        self.start = start
+        self.blocks = blocks
+
+    def __len__(self):
+        return self.start + len(self.blocks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < self.start:
+            return self.chain[index]
+        return self.blocks[index - self.start]
+
+    def hash_at(self, index):
+        if index < self.start:
+            return self.chain.hash_at(index)
+        return self.blocks[index - self.start].hash
+
+    def fork(self, start, blocks):
+        shared = min(start, self.start)
+        return ChainFork(self.chain, shared, self[shared:start] + list(blocks))
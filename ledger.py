@@ -0,0 +1,104 @@
+from threading import RLock
+
+
+class BalanceLedger:
+    """ An index of the balance of every participant of the blockchain
+
+    Confirmed balances are kept up to date as blocks are appended to the chain,
+    while the amounts sent by open transactions are tracked in a separate
+    pending layer, so looking up a balance never has to scan the chain.
+    Changes which belong together, e.g. a block and the open transactions it confirms,
+    are made while holding batch(), so a balance is never read in between.
+
+    Attributes:
+        :confirmed: The amount received minus the amount sent per participant in mined blocks
+        :pending: The amount sent per participant in open transactions
+    """
+
+    def __init__(self):
+        self.confirmed = {}
+        self.pending = {}
+        self.__lock = RLock()
+
+    def batch(self):
+        """ Returns the lock to hold while making several changes, readers wait until all are made """
+        return self.__lock
+
+    def rebuild(self, chain, open_transactions):
+        """ Recomputes the whole index from a chain and its open transactions
+
+        Arguments:
+            :chain: The list of blocks
+            :open_transactions: The list of open transactions
+        """
+        with self.__lock:
+            self.confirmed = {}
+            self.pending = {}
+            for block in chain:
+                self.apply_block(block)
+            for tx in open_transactions:
+                self.add_pending(tx)
+
+    def apply_block(self, block):
+        """ Adds the transactions of a newly appended block to the confirmed balances
+
+        Arguments:
+            :block: The block which was appended to the chain
+        """
+        with self.__lock:
+            for tx in block.transactions:
+                self.confirmed[tx.sender] = self.confirmed.get(
+                    tx.sender, 0) - tx.amount
+                self.confirmed[tx.recipient] = self.confirmed.get(
+                    tx.recipient, 0) + tx.amount
+
+    def revert_block(self, block):
+        """ Removes the transactions of a block which is rolled back from the confirmed balances
+
+        Arguments:
+            :block: The block which was removed from the chain
+        """
+        with self.__lock:
+            for tx in block.transactions:
+                self.confirmed[tx.sender] = self.confirmed.get(
+                    tx.sender, 0) + tx.amount
+                self.confirmed[tx.recipient] = self.confirmed.get(
+                    tx.recipient, 0) - tx.amount
+
+    def add_pending(self, transaction):
+        """ Reserves the amount of an open transaction from its sender's balance
+
+        Arguments:
+            :transaction: The transaction which was added to the open transactions
+        """
+        with self.__lock:
+            self.pending[transaction.sender] = self.pending.get(
+                transaction.sender, 0) + transaction.amount
+
+    def remove_pending(self, transaction):
+        """ Releases the amount of an open transaction which left the open transactions
+
+        Arguments:
+            :transaction: The transaction which was removed from the open transactions
+        """
+        with self.__lock:
+            remaining = self.pending.get(
+                transaction.sender, 0) - transaction.amount
+            if remaining:
+                self.pending[transaction.sender] = remaining
+            else:
+                self.pending.pop(transaction.sender, None)
+
+    def clear_pending(self):
+        """ Drops the pending layer, e.g. after all open transactions were mined """
+        with self.__lock:
+            self.pending = {}
+
+    def balance(self, participant):
+        """ Returns the balance of a participant including its open transactions
+
+        Arguments:
+            :participant: The public key of the participant
+        """
+        with self.__lock:
+            return self.confirmed.get(participant, 0) - self.pending.get(participant, 0)
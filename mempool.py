@@ -0,0 +1,147 @@
+from collections import OrderedDict
+from threading import Lock
+
+from utils.hash_util import hash_transaction
+
+# Maximum number of open transactions kept
+MEMPOOL_MAX_COUNT = 10000
+# Maximum total size of the open transactions in bytes
+MEMPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+
+def transaction_size(transaction):
+    """ Estimates the number of bytes a transaction takes when it is serialized
+
+    Arguments:
+        :transaction: The transaction
+    """
+    return len(transaction.sender) + len(transaction.recipient) + len(transaction.signature) + 32
+
+
+class Mempool:
+    """ The open transactions, indexed by their id (see hash_transaction) in the order they arrived.
+
+    Duplicates are rejected, confirmed transactions are removed in O(1) each, and once
+    the count or byte limit is exceeded the oldest transactions are evicted first.
+    Readers get an immutable snapshot, which is built once per change and shared,
+    so they can iterate while other threads add or remove transactions.
+    Every change is also recorded until it's taken with take_changes, so only the changes
+    have to be saved instead of all open transactions.
+
+    Attributes:
+        :max_count: The maximum number of transactions
+        :max_bytes: The maximum total size of the transactions
+        :size_bytes: The current total size of the transactions
+    """
+
+    def __init__(self, max_count=MEMPOOL_MAX_COUNT, max_bytes=MEMPOOL_MAX_BYTES):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self.__transactions = OrderedDict()
+        self.__snapshot = ()
+        self.__changes = []
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__transactions)
+
+    def __contains__(self, tx_id):
+        return tx_id in self.__transactions
+
+    def __iter__(self):
+        return iter(self.transactions())
+
+    def get(self, tx_id):
+        """ Returns the open transaction with the given id or None
+
+        Arguments:
+            :tx_id: The id of the transaction (see hash_transaction)
+        """
+        return self.__transactions.get(tx_id)
+
+    def transactions(self):
+        """ Returns a tuple of the transactions in arrival order, which isn't affected by later changes """
+        snapshot = self.__snapshot
+        if snapshot is None:
+            with self.__lock:
+                if self.__snapshot is None:
+                    self.__snapshot = tuple(self.__transactions.values())
+                snapshot = self.__snapshot
+        return snapshot
+
+    def template(self, max_count=None):
+        """ Returns the oldest transactions, which go into the next block
+
+        Arguments:
+            :max_count: The maximum number of transactions (default: all)
+        """
+        if max_count is None:
+            return list(self.transactions())
+        return list(self.transactions()[:max_count])
+
+    def add(self, transaction):
+        """ Adds a transaction unless it is already known.
+        Returns whether it was added and the list of transactions evicted to make room for it.
+
+        Arguments:
+            :transaction: The transaction to add
+        """
+        tx_id = hash_transaction(transaction)
+        size = transaction_size(transaction)
+        with self.__lock:
+            if tx_id in self.__transactions or size > self.max_bytes:
+                return False, []
+
+            self.__transactions[tx_id] = transaction
+            self.size_bytes += size
+            self.__snapshot = None
+            self.__changes.append(('add', transaction))
+
+            evicted = []
+            while len(self.__transactions) > self.max_count or self.size_bytes > self.max_bytes:
+                oldest_id, oldest = self.__transactions.popitem(last=False)
+                self.size_bytes -= transaction_size(oldest)
+                self.__changes.append(('remove', oldest_id))
+                evicted.append(oldest)
+        return True, evicted
+
+    def remove(self, transaction):
+        """ Removes a transaction, e.g. because it was confirmed by a block.
+        Returns the removed transaction or None if it wasn't open.
+
+        Arguments:
+            :transaction: The transaction to remove
+        """
+        return self.pop(hash_transaction(transaction))
+
+    def pop(self, tx_id):
+        """ Removes the transaction with the given id.
+        Returns the removed transaction or None if it wasn't open.
+
+        Arguments:
+            :tx_id: The id of the transaction (see hash_transaction)
+        """
+        with self.__lock:
+            removed = self.__transactions.pop(tx_id, None)
+            if removed is not None:
+                self.size_bytes -= transaction_size(removed)
+                self.__snapshot = None
+                self.__changes.append(('remove', tx_id))
+        return removed
+
+    def clear(self):
+        with self.__lock:
+            self.__transactions.clear()
+            self.size_bytes = 0
+            self.__snapshot = ()
+            self.__changes.append(('clear',))
+
+    def take_changes(self):
+        """ Returns the changes since the last call in the order they were made and forgets them.
+        A change is ('add', transaction), ('remove', tx_id) or ('clear',).
+        """
+        with self.__lock:
+            changes = self.__changes
+            self.__changes = []
+        return changes
@@ -0,0 +1,290 @@
+""" Provides a proof of work miner which spreads the nonce space over several processes,
+and a queue running mining jobs in the background
+"""
+
+from collections import OrderedDict
+import os
+import queue
+from threading import Event, Lock, Thread
+from time import time
+from uuid import uuid4
+
+from utils.hash_util import hash_prefix_256
+from utils.pool import POOL_TIMEOUT, pool_context
+from utils.profiler import profiler
+from utils.verification import Verification
+
+# Number of consecutive nonces a worker checks before looking at the stop flags again
+NONCE_CHUNK = 5000
+# Number of finished mining jobs whose status is kept
+MINING_JOB_HISTORY = 100
+# Seconds between the checks whether the worker processes are still alive while waiting for their results
+WORKER_POLL_INTERVAL = 1
+
+
+def search_nonces(worker_id, workers, guess_prefix, found, cancelled, results, progress):
+    """ Checks the nonce ranges assigned to one worker until a valid proof is found
+    by any worker or the search is cancelled.
+
+    Worker i checks the chunks i, i + workers, i + 2 * workers, ... of NONCE_CHUNK nonces.
+
+    Arguments:
+        :worker_id: The number of the worker
+        :workers: The total number of workers
+        :guess_prefix: The encoded transactions and previous hash (see Verification.proof_prefix)
+        :found: Event which is set once any worker found a valid proof
+        :cancelled: Event which is set when the search should be given up
+        :results: Queue receiving (worker_id, proof or None, nonces tried, seconds taken)
+        :progress: Shared counter of the nonces tried by all workers, updated after every chunk
+    """
+    start = time()
+    tried = 0
+    proof = None
+    chunk_start = worker_id * NONCE_CHUNK
+    # The prefix is hashed once, every nonce only costs a copy of the state
+    prefix_hash = hash_prefix_256(guess_prefix)
+    valid_guess = Verification.valid_guess
+
+    while proof is None and not found.is_set() and not cancelled.is_set():
+        for nonce in range(chunk_start, chunk_start + NONCE_CHUNK):
+            if valid_guess(prefix_hash, nonce):
+                proof = nonce
+                tried += nonce - chunk_start + 1
+                found.set()
+                with progress.get_lock():
+                    progress.value += nonce - chunk_start + 1
+                break
+        else:
+            tried += NONCE_CHUNK
+            with progress.get_lock():
+                progress.value += NONCE_CHUNK
+        chunk_start += workers * NONCE_CHUNK
+
+    results.put((worker_id, proof, tried, time() - start))
+
+
+class Miner:
+    """ Searches for a valid proof of work using a configurable number of processes
+
+    Attributes:
+        :workers: The number of worker processes (defaults to the number of cores)
+        :hash_rates: The hashes per second of each worker during the last search
+        :started: The time the running or last search started at
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.hash_rates = {}
+        self.started = None
+        # The workers are started like the pool workers, forking the threaded node could copy held locks
+        self.__context = pool_context()
+        self.__cancelled = self.__context.Event()
+        self.__progress = self.__context.Value('Q', 0)
+
+    def progress(self):
+        """ Returns the number of nonces tried and the hashes per second of the running or last search """
+        tried = self.__progress.value
+        elapsed = time() - self.started if self.started is not None else 0
+        return tried, tried / elapsed if elapsed else 0
+
+    def cancel(self):
+        """ Stops the running search, e.g. because a competing block was accepted,
+        or the next one if it's called before that search starts
+        """
+        self.__cancelled.set()
+
+    def prepare(self):
+        """ Takes back earlier cancellations, to be called together with taking the block template,
+        so a cancellation after that still stops the search on the template
+        """
+        self.__cancelled.clear()
+
+    def mine(self, transactions, last_hash):
+        """ Returns the first valid proof found by any worker,
+        or None if the search was cancelled since prepare was called.
+        Raises a RuntimeError if a worker process died without reporting.
+
+        Arguments:
+            :transactions: The transactions of the new block (without the reward)
+            :last_hash: The hash of the previous block
+        """
+        self.__progress.value = 0
+        self.started = time()
+        guess_prefix = Verification.proof_prefix(transactions, last_hash)
+        found = self.__context.Event()
+
+        if self.workers == 1:
+            # No need to pay for a process when there is nothing to spread the work over
+            results = queue.Queue()
+            search_nonces(0, 1, guess_prefix, found,
+                          self.__cancelled, results, self.__progress)
+            processes = []
+        else:
+            results = self.__context.Queue()
+            processes = [
+                self.__context.Process(target=search_nonces, args=(
+                    worker_id, self.workers, guess_prefix, found, self.__cancelled, results, self.__progress),
+                    daemon=True)
+                for worker_id in range(self.workers)
+            ]
+            for process in processes:
+                process.start()
+
+        proof = None
+        hash_rates = {}
+        while len(hash_rates) < self.workers:
+            try:
+                worker_id, worker_proof, tried, elapsed = results.get(timeout=WORKER_POLL_INTERVAL)
+            except queue.Empty:
+                # A worker which exits normally reports first, any other exit means it crashed
+                crashed = [process for worker_id, process in enumerate(processes)
+                           if worker_id not in hash_rates and process.exitcode not in (None, 0)]
+                if crashed:
+                    found.set()
+                    for process in processes:
+                        process.join(POOL_TIMEOUT)
+                    raise RuntimeError(f'A mining worker exited with code {crashed[0].exitcode}')
+                continue
+            hash_rates[worker_id] = tried / elapsed if elapsed else 0
+            # Several workers may hit a proof in the same chunk, the first reported one wins
+            if proof is None and worker_proof is not None:
+                proof = worker_proof
+
+        for process in processes:
+            process.join()
+
+        self.hash_rates = hash_rates
+        return proof
+
+
+class MiningJob:
+    """ A request to mine one block, run in the background by the MiningJobs queue
+
+    Attributes:
+        :id: The id of the job
+        :status: 'queued', 'running', 'done' or 'failed'
+        :attempts: The number of proof of work searches started, one more for every restart
+        :nonces_tried: The number of nonces tried by the finished searches
+        :hash_rate: The hashes per second of the last finished search
+        :created: The time the job was queued at
+        :finished: The time the job was done or failed at
+        :block: The dictionary of the mined block once the job is done
+        :error: The error the job failed with, if mining raised one
+    """
+
+    def __init__(self):
+        self.id = uuid4().hex
+        self.status = 'queued'
+        self.attempts = 0
+        self.nonces_tried = 0
+        self.hash_rate = 0
+        self.created = time()
+        self.finished = None
+        self.block = None
+        self.error = None
+
+
+class MiningJobs:
+    """ Runs mining jobs one after another in a background thread.
+
+    A running search is restarted on a fresh block template whenever restart is called,
+    i.e. when new transactions arrive or another block is added to the chain.
+
+    Arguments:
+        :miner: The miner doing the proof of work, used for cancelling and progress reports
+        :mine_block: Function mining a block on the current template, returning the block or None
+    """
+
+    def __init__(self, miner, mine_block):
+        self.__miner = miner
+        self.__mine_block = mine_block
+        self.__jobs = OrderedDict()
+        self.__queue = queue.Queue()
+        self.__restart = Event()
+        self.__lock = Lock()
+        self.__current = None
+        self.__attempt_started = None
+        self.__thread = None
+
+    def submit(self):
+        """ Queues a new job and returns it """
+        job = MiningJob()
+        with self.__lock:
+            self.__jobs[job.id] = job
+            # Only the most recent jobs are remembered, running ones are never dropped
+            for old_id in list(self.__jobs)[:max(len(self.__jobs) - MINING_JOB_HISTORY, 0)]:
+                if self.__jobs[old_id].finished is not None:
+                    del self.__jobs[old_id]
+            # The thread is only started once there is something to mine
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name='mining', daemon=True)
+                self.__thread.start()
+        self.__queue.put(job)
+        return job
+
+    def restart(self):
+        """ Makes the running job start over on a fresh block template """
+        self.__restart.set()
+        self.__miner.cancel()
+
+    def status(self, job_id):
+        """ Returns the status of a job as a dictionary, or None for an unknown job
+
+        Arguments:
+            :job_id: The id returned when the job was submitted
+        """
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+        if job is None:
+            return None
+        status = {
+            'id': job.id,
+            'status': job.status,
+            'attempts': job.attempts,
+            'nonces_tried': job.nonces_tried,
+            'hash_rate': job.hash_rate,
+            'created': job.created,
+            'finished': job.finished,
+            'block': job.block,
+            'error': job.error
+        }
+        if job is self.__current and self.__searching():
+            # The search which is still running is added to the finished ones
+            tried, status['hash_rate'] = self.__miner.progress()
+            status['nonces_tried'] += tried
+        return status
+
+    def __searching(self):
+        # The block template may be rejected before a proof of work search is started
+        started = self.__miner.started
+        return started is not None and self.__attempt_started is not None and started >= self.__attempt_started
+
+    def __run(self):
+        while True:
+            job = self.__queue.get()
+            self.__current = job
+            job.status = 'running'
+            self.__restart.clear()
+            block = None
+            while block is None:
+                job.attempts += 1
+                self.__attempt_started = time()
+                # With several workers the search runs in other processes and only shows up as waiting
+                try:
+                    with profiler.profile('mine_block'):
+                        block = self.__mine_block()
+                except Exception as error:
+                    # The job fails, but the thread keeps running the queued jobs
+                    job.error = repr(error)
+                searched = self.__searching()
+                self.__attempt_started = None
+                if searched:
+                    tried, job.hash_rate = self.__miner.progress()
+                    job.nonces_tried += tried
+                if job.error is not None or block is None and not self.__restart.is_set():
+                    break
+                self.__restart.clear()
+            self.__current = None
+            job.block = block.to_dict() if block is not None else None
+            job.status = 'done' if block is not None else 'failed'
+            job.finished = time()
@@ -0,0 +1,188 @@
+""" Provides the peer nodes together with the health of each of them """
+
+from threading import Lock
+from time import time
+
+# Consecutive failed requests after which a peer is skipped for a while
+PEER_FAILURE_THRESHOLD = 3
+# Seconds a failing peer is skipped at first, doubled with every further failure
+PEER_BACKOFF = 2
+# Maximum number of seconds a failing peer is skipped
+PEER_MAX_BACKOFF = 300
+# Seconds without a successful request after which a failing peer is demoted
+PEER_DEMOTE_AFTER = 3600
+# Seconds between the attempts to reach a demoted peer
+PEER_DEMOTED_RETRY = 3600
+# Weight of the latest request in the moving average of the latency
+PEER_LATENCY_WEIGHT = 0.2
+
+
+class PeerState:
+    """ The request statistics and the circuit breaker state of a peer
+
+    Attributes:
+        :node: The node URL
+        :status: 'healthy', 'failing' while it is skipped after repeated failures or 'demoted' once it stayed unreachable
+        :requests: The number of requests sent to the peer
+        :failures: The number of requests which failed, e.g. because of a timeout
+        :consecutive_failures: The number of requests which failed since the last successful one
+        :latency: The moving average of the seconds a request took
+        :added: The time the peer was added
+        :last_success: The time of the last successful request
+        :last_failure: The time of the last failed request
+        :last_error: The kind of error of the last failed request
+        :retry_at: The time the peer is tried again while it's skipped
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.status = 'healthy'
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.added = time()
+        self.last_success = None
+        self.last_failure = None
+        self.last_error = None
+        self.retry_at = None
+
+    def to_dict(self):
+        return {
+            'node': self.node,
+            'status': self.status,
+            'requests': self.requests,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'latency': self.latency,
+            'last_success': self.last_success,
+            'last_failure': self.last_failure,
+            'last_error': self.last_error,
+            'retry_in': max(self.retry_at - time(), 0) if self.retry_at is not None else None
+        }
+
+
+class PeerManager:
+    """ The peer nodes and their health, so requests are only sent to peers which are likely to answer.
+
+    After a few consecutive failures a peer's circuit opens and the peer is skipped, for a time
+    which doubles with every further failure. Once that time is up a single request is let through,
+    if it succeeds the peer is healthy again. A peer which didn't answer for a long time is demoted
+    and only tried once in a while, until it is removed or answers again.
+
+    Arguments:
+        :failure_threshold: The number of consecutive failures after which a peer is skipped
+        :backoff: The seconds a failing peer is skipped at first
+        :max_backoff: The maximum number of seconds a failing peer is skipped
+        :demote_after: The seconds without a successful request after which a failing peer is demoted
+        :demoted_retry: The seconds between the attempts to reach a demoted peer
+    """
+
+    def __init__(self, failure_threshold=PEER_FAILURE_THRESHOLD, backoff=PEER_BACKOFF, max_backoff=PEER_MAX_BACKOFF,
+                 demote_after=PEER_DEMOTE_AFTER, demoted_retry=PEER_DEMOTED_RETRY):
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.demote_after = demote_after
+        self.demoted_retry = demoted_retry
+        self.__peers = {}
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__peers)
+
+    def __contains__(self, node):
+        return node in self.__peers
+
+    def reset(self, nodes):
+        """ Replaces all peers, e.g. with the ones loaded from the store
+
+        Arguments:
+            :nodes: The node URLs
+        """
+        with self.__lock:
+            self.__peers = {node: PeerState(node) for node in nodes}
+
+    def add(self, node):
+        """ Adds a peer, a known peer keeps its statistics
+
+        Arguments:
+            :node: The node URL
+        """
+        with self.__lock:
+            if node not in self.__peers:
+                self.__peers[node] = PeerState(node)
+
+    def remove(self, node):
+        """ Removes a peer together with its statistics
+
+        Arguments:
+            :node: The node URL
+        """
+        with self.__lock:
+            self.__peers.pop(node, None)
+
+    def nodes(self):
+        """ Returns the URLs of all peers, including the failing and demoted ones """
+        with self.__lock:
+            return list(self.__peers)
+
+    def available(self):
+        """ Returns the URLs of the peers which should be contacted now.
+        A skipped peer whose time is up is returned once, the result of that request decides how it goes on.
+        """
+        now = time()
+        nodes = []
+        with self.__lock:
+            for peer in self.__peers.values():
+                if peer.retry_at is None:
+                    nodes.append(peer.node)
+                elif peer.retry_at <= now:
+                    # Other callers keep skipping the peer until the trial request is recorded
+                    peer.retry_at = now + self.__skip_time(peer)
+                    nodes.append(peer.node)
+        return nodes
+
+    def record(self, node, seconds, error=None):
+        """ Records the result of a request to a peer
+
+        Arguments:
+            :node: The node URL
+            :seconds: The time the request took
+            :error: The exception the request failed with, None if the peer answered
+        """
+        now = time()
+        with self.__lock:
+            peer = self.__peers.get(node)
+            if peer is None:
+                return
+            peer.requests += 1
+            if error is None:
+                peer.latency = seconds if peer.latency is None else (
+                    PEER_LATENCY_WEIGHT * seconds + (1 - PEER_LATENCY_WEIGHT) * peer.latency)
+                peer.last_success = now
+                peer.consecutive_failures = 0
+                peer.status = 'healthy'
+                peer.retry_at = None
+                return
+            peer.failures += 1
+            peer.consecutive_failures += 1
+            peer.last_failure = now
+            peer.last_error = type(error).__name__
+            if peer.consecutive_failures < self.failure_threshold:
+                return
+            if now - (peer.last_success or peer.added) >= self.demote_after:
+                peer.status = 'demoted'
+            else:
+                peer.status = 'failing'
+            peer.retry_at = now + self.__skip_time(peer)
+
+    def __skip_time(self, peer):
+        if peer.status == 'demoted':
+            return self.demoted_retry
+        return min(self.backoff * 2 ** max(peer.consecutive_failures - self.failure_threshold, 0), self.max_backoff)
+
+    def stats(self):
+        """ Returns the statistics and state of every peer """
+        with self.__lock:
+            return [peer.to_dict() for peer in self.__peers.values()]
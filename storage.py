@@ -0,0 +1,326 @@
+""" Provides an append-only, segmented storage engine for the blockchain """
+
+import json
+import os
+import struct
+from threading import Lock
+import zlib
+
+from utils.codec import decode_block, encode_block
+
+# Every record is framed by its payload length and the CRC32 of the payload
+RECORD_HEADER = struct.Struct('>II')
+# A new segment file is started once the current one grows beyond this size
+SEGMENT_SIZE = 16 * 1024 * 1024
+# Every block has an index entry of its segment number, offset, payload length and raw hash
+INDEX_RECORD = struct.Struct('>III32s')
+
+
+class BlockStore:
+    """ Stores blocks as checksummed, binary encoded records in append-only segment files,
+    while the open transactions and peer nodes are kept in small separate files.
+    Changes of the open transactions are appended to a journal, which is replayed
+    on top of the last saved open transactions when they are loaded.
+
+    A fixed-width index file holds the position and hash of every block,
+    so any block or hash can be read without scanning the segment files.
+
+    Attributes:
+        :path: The directory holding the segment files
+        :height: The number of blocks in the store
+        :journal_length: The number of changes in the journal of the open transactions
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.height = 0
+        self.journal_length = 0
+        os.makedirs(self.path, exist_ok=True)
+        self.__lock = Lock()
+        self.__index = None
+
+    def __segment_path(self, segment):
+        return os.path.join(self.path, f'blocks-{segment:05d}.log')
+
+    def __segments(self):
+        return sorted(int(name[7:12]) for name in os.listdir(self.path)
+                      if name.startswith('blocks-') and name.endswith('.log'))
+
+    def is_empty(self):
+        return not self.__segments()
+
+    def open(self, block_hash):
+        """ Opens the block index, which is rebuilt from the segment files where it is missing or behind
+        (e.g. for stores written before it existed or after a crash). Only the records after the
+        last indexed block are read, so opening takes the same time however long the chain is.
+
+        Arguments:
+            :block_hash: Function returning the hash of a stored block dictionary which has none cached
+        """
+        index = open(os.path.join(self.path, 'blocks.idx'), mode='a+b')
+        # Opening again, e.g. when the node data is reloaded, replaces the handle of the last time
+        with self.__lock:
+            previous_index, self.__index = self.__index, index
+        if previous_index is not None:
+            previous_index.close()
+        size = os.path.getsize(self.__index.name)
+        self.height = size // INDEX_RECORD.size
+        # Entries can only be ahead of the segment files if these were damaged
+        while self.height > 0:
+            segment, offset, length, _ = self.__entry(self.height - 1)
+            segment_path = self.__segment_path(segment)
+            if os.path.exists(segment_path) and os.path.getsize(segment_path) >= offset + RECORD_HEADER.size + length:
+                break
+            self.height -= 1
+        if size != self.height * INDEX_RECORD.size:
+            self.__index.truncate(self.height * INDEX_RECORD.size)
+
+        if self.height > 0:
+            segment, offset, length, _ = self.__entry(self.height - 1)
+            offset += RECORD_HEADER.size + length
+        else:
+            segment, offset = 0, 0
+        for segment, offset, payload in self.__scan(segment, offset):
+            block = self.__decode(payload)
+            self.__add_entry(segment, offset, len(payload), block.get('hash') or block_hash(block))
+
+    def close(self):
+        """ Closes the block index, the store has to be opened again before blocks are read or appended """
+        with self.__lock:
+            if self.__index is not None:
+                self.__index.close()
+                self.__index = None
+
+    def __scan(self, first_segment, first_offset):
+        # Yields the (segment, offset, payload) of the records from the given position onwards.
+        # A torn or corrupted record (e.g. after a crash) is cut off together with everything stored after it.
+        segments = [segment for segment in self.__segments() if segment >= first_segment]
+        for position, segment in enumerate(segments):
+            offset = first_offset if segment == first_segment else 0
+            with open(self.__segment_path(segment), mode='rb') as f:
+                f.seek(offset)
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if not header:
+                        break
+                    payload = b''
+                    if len(header) == RECORD_HEADER.size:
+                        length, checksum = RECORD_HEADER.unpack(header)
+                        payload = f.read(length)
+                    if (len(header) < RECORD_HEADER.size or len(payload) < length
+                            or zlib.crc32(payload) != checksum):
+                        print('Discarding corrupted block records')
+                        self.__cut(segment, offset, segments[position + 1:])
+                        return
+                    yield segment, offset, payload
+                    offset += RECORD_HEADER.size + length
+
+    def __entry(self, height):
+        with self.__lock:
+            # Blocks may be truncated by another thread after their height was looked up
+            if not 0 <= height < self.height:
+                raise IndexError('Block index out of range')
+            self.__index.seek(height * INDEX_RECORD.size)
+            return INDEX_RECORD.unpack(self.__index.read(INDEX_RECORD.size))
+
+    def __add_entry(self, segment, offset, length, block_hash):
+        with self.__lock:
+            self.__index.write(INDEX_RECORD.pack(segment, offset, length, bytes.fromhex(block_hash)))
+            self.__index.flush()
+            self.height += 1
+
+    def hash_at(self, height):
+        """ Returns the hash of a stored block without reading the block
+
+        Arguments:
+            :height: The index of the block
+        """
+        return self.__entry(height)[3].hex()
+
+    def hashes(self, start, limit):
+        """ Returns the hashes of a range of stored blocks
+
+        Arguments:
+            :start: The index of the first block
+            :limit: The maximum number of hashes
+        """
+        end = min(self.height, start + limit)
+        if start >= end:
+            return []
+        with self.__lock:
+            self.__index.seek(start * INDEX_RECORD.size)
+            data = self.__index.read((end - start) * INDEX_RECORD.size)
+        return [entry[3].hex() for entry in INDEX_RECORD.iter_unpack(data)]
+
+    def read_block(self, height):
+        """ Reads a single block as a dictionary, raises ValueError if its record is corrupted
+
+        Arguments:
+            :height: The index of the block
+        """
+        segment, offset, length, _ = self.__entry(height)
+        with open(self.__segment_path(segment), mode='rb') as f:
+            f.seek(offset)
+            record = f.read(RECORD_HEADER.size + length)
+        if len(record) < RECORD_HEADER.size + length:
+            raise ValueError('Truncated block record')
+        _, checksum = RECORD_HEADER.unpack_from(record)
+        payload = record[RECORD_HEADER.size:]
+        if zlib.crc32(payload) != checksum:
+            raise ValueError('Corrupted block record')
+        return self.__decode(payload)
+
+    def iter_blocks(self, start=0):
+        """ Streams the stored blocks one at a time as dictionaries
+
+        Arguments:
+            :start: The index of the first block
+        """
+        for height in range(start, self.height):
+            yield self.read_block(height)
+
+    def append_block(self, block):
+        """ Appends a single block to the end of the log
+
+        Arguments:
+            :block: The dictionary representation of the block, including its hash
+        """
+        payload = encode_block(block)
+        segments = self.__segments()
+        segment = segments[-1] if segments else 0
+        segment_path = self.__segment_path(segment)
+        if os.path.exists(segment_path) and os.path.getsize(segment_path) >= SEGMENT_SIZE:
+            segment += 1
+            segment_path = self.__segment_path(segment)
+
+        with open(segment_path, mode='ab') as f:
+            offset = f.tell()
+            f.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # The record is written first, a missing index entry is restored when the store is opened
+        self.__add_entry(segment, offset, len(payload), block['hash'])
+
+    @staticmethod
+    def __decode(payload):
+        # Records written before the binary encoding are JSON objects
+        if payload[:1] == b'{':
+            return json.loads(payload.decode())
+        return decode_block(payload)
+
+    def truncate(self, height):
+        """ Removes all blocks from the given height onwards
+
+        Arguments:
+            :height: The number of blocks which should be kept
+        """
+        if height >= self.height:
+            return
+        segment, offset, _, _ = self.__entry(height)
+        # Readers stop seeing the blocks before their records are removed
+        with self.__lock:
+            self.height = height
+            self.__index.truncate(height * INDEX_RECORD.size)
+        self.__cut(segment, offset,
+                   [s for s in self.__segments() if s > segment])
+
+    def __cut(self, segment, offset, later_segments):
+        with open(self.__segment_path(segment), mode='r+b') as f:
+            f.truncate(offset)
+        for later in later_segments:
+            os.remove(self.__segment_path(later))
+
+    def __read_json(self, name, default):
+        try:
+            with open(os.path.join(self.path, name), mode='r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return default
+
+    def __write_json(self, name, value):
+        # Written to a temporary file first so a crash never leaves a half-written file
+        file_path = os.path.join(self.path, name)
+        with open(file_path + '.tmp', mode='w') as f:
+            json.dump(value, f)
+        os.replace(file_path + '.tmp', file_path)
+
+    def load_open_transactions(self):
+        """ Returns the last saved open transactions and the changes appended to the journal since """
+        changes = []
+        try:
+            with open(os.path.join(self.path, 'mempool.log'), mode='r+b') as f:
+                offset = 0
+                for line in f:
+                    try:
+                        changes.append(json.loads(line))
+                    except ValueError:
+                        # The last change may be half-written after a crash, it's cut off so new changes follow the valid ones
+                        f.truncate(offset)
+                        break
+                    offset += len(line)
+        except IOError:
+            pass
+        self.journal_length = len(changes)
+        return self.__read_json('mempool.json', []), changes
+
+    def save_open_transactions(self, transactions):
+        """ Saves all open transactions and empties the journal
+
+        Arguments:
+            :transactions: The dictionaries of the open transactions
+        """
+        self.__write_json('mempool.json', transactions)
+        # Replaying the journal again after a crash right here leads to the same transactions
+        open(os.path.join(self.path, 'mempool.log'), mode='w').close()
+        self.journal_length = 0
+
+    def append_open_transaction_changes(self, changes):
+        """ Appends changes of the open transactions to the journal
+
+        Arguments:
+            :changes: The changes, e.g. ['add', transaction dictionary], ['remove', tx_id] or ['clear']
+        """
+        with open(os.path.join(self.path, 'mempool.log'), mode='a') as f:
+            f.writelines(json.dumps(change) + '\n' for change in changes)
+        self.journal_length += len(changes)
+
+    def load_snapshot(self):
+        return self.__read_json('snapshot.json', None)
+
+    def save_snapshot(self, snapshot):
+        self.__write_json('snapshot.json', snapshot)
+
+    def load_peer_nodes(self):
+        return self.__read_json('peers.json', [])
+
+    def save_peer_nodes(self, peer_nodes):
+        self.__write_json('peers.json', peer_nodes)
+
+    def migrate_legacy_file(self, file_path, prepare_block):
+        """ Imports a blockchain file in the old three-line format
+        (chain, open transactions, peer nodes) into an empty store.
+
+        The old file is renamed afterwards so the migration only ever runs once.
+
+        Arguments:
+            :file_path: The path of the old blockchain file
+            :prepare_block: Function converting a block of the old file to the dictionary which is stored
+        """
+        if not os.path.exists(file_path) or not self.is_empty():
+            return False
+
+        with open(file_path, mode='r') as f:
+            file_content = [json.loads(line.rstrip('\n'))
+                            for line in f.readlines()]
+
+        for block in file_content[0]:
+            self.append_block(prepare_block(block))
+        if len(file_content) > 1:
+            self.save_open_transactions(file_content[1])
+        if len(file_content) > 2:
+            self.save_peer_nodes(file_content[2])
+
+        os.replace(file_path, file_path + '.migrated')
+        return True
@@ -1,10 +1,21 @@
 from collections import OrderedDict
+import binascii
+import sys
 
 from utils.printable import Printable
 
 
+def intern_key(key):
+    """ Returns the shared copy of a public key, so every key is only kept in memory once
+
+    Arguments:
+        :key: The hex encoded public key (or 'MINING')
+    """
+    return sys.intern(key) if type(key) is str else key
+
+
 class Transaction(Printable):
-    """ A transaction which can be added to the blockchain
+    """ A transaction which can be added to the blockchain, it can't be changed once it was created
 
     Attributes:
         :sender: The sender of the coins
@@ -13,11 +24,57 @@ class Transaction(Printable):
         :amount: The amount of coins sent
     """
 
+    # No per-instance __dict__, the keys are interned and the signature is kept as raw bytes
+    __slots__ = ('sender', 'recipient', '_signature', 'amount')
+
     def __init__(self, sender, recipient, signature, amount):
-        self.sender = sender
-        self.recipient = recipient
-        self.signature = signature
-        self.amount = amount
+        initialise = super().__setattr__
+        initialise('sender', intern_key(sender))
+        initialise('recipient', intern_key(recipient))
+        initialise('_signature', self.__pack_signature(signature))
+        initialise('amount', amount)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            'A transaction can not be changed once it was created')
+
+    def __reduce__(self):
+        return (Transaction, (self.sender, self.recipient, self.signature, self.amount))
+
+    @staticmethod
+    def __pack_signature(signature):
+        # Only signatures which convert back to exactly the same hex string are packed
+        try:
+            packed = binascii.unhexlify(signature)
+            if binascii.hexlify(packed).decode('ascii') == signature:
+                return packed
+        except (TypeError, ValueError, binascii.Error):
+            pass
+        return signature
+
+    @property
+    def signature(self):
+        if type(self._signature) is bytes:
+            return binascii.hexlify(self._signature).decode('ascii')
+        return self._signature
 
     def to_ordered_dict(self):
         return OrderedDict([('sender', self.sender), ('recipient', self.recipient), ('amount', self.amount)])
+
+    def to_dict(self):
+        """ Converts the transaction to a dictionary which can be sent as JSON """
+        return {
+            'sender': self.sender,
+            'recipient': self.recipient,
+            'signature': self.signature,
+            'amount': self.amount
+        }
+
+    @classmethod
+    def from_dict(cls, transaction):
+        """ Creates a transaction from its dictionary representation
+
+        Arguments:
+            :transaction: The dictionary
+        """
+        return cls(transaction['sender'], transaction['recipient'], transaction['signature'], transaction['amount'])
@@ -0,0 +1,168 @@
+""" Provides a persistent index of the confirmed transactions by id and by address """
+
+import json
+
+from utils.hash_util import hash_transaction
+
+
+class TransactionIndex:
+    """ Maps transaction ids to their (block index, position) and addresses to the
+    references of the transactions they sent or received, oldest first.
+
+    The index is kept up to date block by block and persisted as an append-only file
+    with one line per block holding the ids and addresses of its transactions. It is only
+    loaded once it is first used, without reading any block which was indexed before.
+    Transactions which occur more than once (e.g. identical mining rewards) are located
+    at their first occurrence.
+
+    Attributes:
+        :path: The file the index is persisted to
+        :height: The number of blocks in the index
+        :loaded: Whether the index was loaded, blocks added or removed before are picked up when loading
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.height = 0
+        self.loaded = False
+        self.__locations = {}
+        self.__addresses = {}
+        # The transaction ids and (sender, recipient) pairs of every indexed block, used for saving
+        self.__block_ids = []
+        self.__block_addresses = []
+        # The file offset of the line of every saved block, used for truncating the file
+        self.__offsets = []
+
+    def load(self, chain):
+        """ Restores the index of a chain from the file, indexing the blocks which are missing.
+        Lines which don't match the chain (e.g. because it was replaced while the index wasn't loaded) are dropped.
+
+        Arguments:
+            :chain: The chain, only the hashes of the blocks which were indexed before are read
+        """
+        self.height = 0
+        self.__locations = {}
+        self.__addresses = {}
+        self.__block_ids = []
+        self.__block_addresses = []
+        self.__offsets = []
+        try:
+            with open(self.path, mode='rb') as f:
+                offset = 0
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        valid = (self.height < len(chain) and entry['index'] == self.height
+                                 and entry['hash'] == chain.hash_at(self.height)
+                                 and len(entry['tx_ids']) == len(entry['addresses']))
+                    except (ValueError, KeyError, TypeError):
+                        valid = False
+                    if not valid:
+                        break
+                    self.__offsets.append(offset)
+                    self.__index_entries(entry['tx_ids'], [tuple(pair) for pair in entry['addresses']])
+                    offset += len(line)
+            self.__truncate_file(offset)
+        except IOError:
+            pass
+
+        self.loaded = True
+        for block in chain.iter_blocks(self.height):
+            self.apply_block(block)
+
+    def apply_block(self, block):
+        """ Adds the transactions of a newly appended block to the index
+
+        Arguments:
+            :block: The block which was appended to the chain
+        """
+        if not self.loaded:
+            return
+        self.__index_entries([hash_transaction(tx) for tx in block.transactions],
+                             [(tx.sender, tx.recipient) for tx in block.transactions])
+
+    def __index_entries(self, tx_ids, addresses):
+        height = self.height
+        for position, (tx_id, (sender, recipient)) in enumerate(zip(tx_ids, addresses)):
+            reference = (height, position)
+            self.__locations.setdefault(tx_id, reference)
+            self.__addresses.setdefault(sender, []).append(reference)
+            if recipient != sender:
+                self.__addresses.setdefault(recipient, []).append(reference)
+        self.__block_ids.append(tuple(tx_ids))
+        self.__block_addresses.append(tuple(addresses))
+        self.height += 1
+
+    def truncate(self, height):
+        """ Rolls the index back to the given height, e.g. before the chain is replaced
+
+        Arguments:
+            :height: The number of blocks which should be kept
+        """
+        if not self.loaded:
+            return
+        for block_index in range(self.height - 1, height - 1, -1):
+            for tx_id, addresses in zip(self.__block_ids[block_index], self.__block_addresses[block_index]):
+                if self.__locations.get(tx_id, (-1,))[0] == block_index:
+                    del self.__locations[tx_id]
+                for address in addresses:
+                    references = self.__addresses.get(address)
+                    # The references of an address are in chain order, so the rolled back ones are at the end
+                    while references and references[-1][0] >= height:
+                        references.pop()
+                    if references == []:
+                        del self.__addresses[address]
+        del self.__block_ids[height:]
+        del self.__block_addresses[height:]
+        self.height = min(self.height, height)
+        if height < len(self.__offsets):
+            self.__truncate_file(self.__offsets[height])
+            del self.__offsets[height:]
+
+    def __truncate_file(self, offset):
+        with open(self.path, mode='r+b') as f:
+            f.truncate(offset)
+
+    def save(self, chain):
+        """ Appends the blocks which are not saved yet to the index file
+
+        Arguments:
+            :chain: The indexed chain
+        """
+        if not self.loaded or len(self.__offsets) >= self.height:
+            return
+        with open(self.path, mode='ab') as f:
+            offset = f.tell()
+            for block_index in range(len(self.__offsets), self.height):
+                line = (json.dumps({'index': block_index, 'hash': chain.hash_at(block_index),
+                                    'tx_ids': self.__block_ids[block_index],
+                                    'addresses': self.__block_addresses[block_index]}) + '\n').encode()
+                f.write(line)
+                self.__offsets.append(offset)
+                offset += len(line)
+
+    def locate(self, tx_id):
+        """ Returns the (block index, position) of a confirmed transaction or None
+
+        Arguments:
+            :tx_id: The id of the transaction (see hash_transaction)
+        """
+        return self.__locations.get(tx_id)
+
+    def address_count(self, address):
+        """ Returns the number of confirmed transactions an address sent or received
+
+        Arguments:
+            :address: The public key of the participant
+        """
+        return len(self.__addresses.get(address, ()))
+
+    def address_references(self, address, start, limit):
+        """ Returns the (block index, position) of a page of the transactions of an address
+
+        Arguments:
+            :address: The public key of the participant
+            :start: The number of transactions to skip
+            :limit: The maximum number of transactions
+        """
+        return self.__addresses.get(address, [])[start:start + limit]
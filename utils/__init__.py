@@ -1,3 +1,3 @@
-from utils.hash_util import hash_string_256, hash_block
+from utils.hash_util import hash_string_256, hash_prefix_256, hash_block, hash_transaction
 
-__all__ = ['hash_string_256', 'hash_block']
+__all__ = ['hash_string_256', 'hash_prefix_256', 'hash_block', 'hash_transaction']
@@ -0,0 +1,220 @@
+""" Provides a compact, versioned binary encoding for blocks and transactions
+
+Keys, signatures and hashes are stored as raw bytes instead of hex strings,
+lengths as varints and numbers as fixed-width 64 bit values. Numbers keep
+whether they were an int or a float, since signatures and hashes depend on str(amount).
+Encoded values decode to the same dictionaries as the JSON representation.
+"""
+
+import struct
+
+VERSION = 2
+# Versions which can still be decoded, version 1 blocks have no merkle root
+SUPPORTED_VERSIONS = (1, 2)
+# Content type peers use to ask for and to send the binary encoding
+CONTENT_TYPE = 'application/x-blockchain-v2'
+
+KIND_TRANSACTION = 1
+KIND_BLOCK = 2
+
+TAG_HEX = 0
+TAG_TEXT = 1
+TAG_INT = 0
+TAG_FLOAT = 1
+
+INT64 = struct.Struct('>q')
+FLOAT64 = struct.Struct('>d')
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _write_string(out, string):
+    # Lower case hex strings (keys, signatures, hashes) are stored as raw bytes
+    tag = TAG_TEXT
+    try:
+        raw = bytes.fromhex(string)
+        if raw.hex() == string:
+            tag = TAG_HEX
+    except ValueError:
+        pass
+    if tag == TAG_TEXT:
+        raw = string.encode('utf8')
+    out.append(tag)
+    _write_varint(out, len(raw))
+    out += raw
+
+
+def _read_string(data, offset):
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    # Lengths below 128 fit into a single byte
+    if length > 0x7f:
+        length, offset = _read_varint(data, offset - 1)
+    end = offset + length
+    if end > len(data):
+        raise ValueError('Truncated string')
+    if tag == TAG_HEX:
+        return data[offset:end].hex(), end
+    return data[offset:end].decode('utf8'), end
+
+
+def _write_number(out, number):
+    if type(number) is int:
+        out.append(TAG_INT)
+        out += INT64.pack(number)
+    elif type(number) is float:
+        out.append(TAG_FLOAT)
+        out += FLOAT64.pack(number)
+    else:
+        raise ValueError('Only int and float numbers can be encoded')
+
+
+def _read_number(data, offset):
+    tag = data[offset]
+    if tag == TAG_INT:
+        return INT64.unpack_from(data, offset + 1)[0], offset + 9
+    if tag == TAG_FLOAT:
+        return FLOAT64.unpack_from(data, offset + 1)[0], offset + 9
+    raise ValueError('Unknown number tag')
+
+
+def _write_transaction(out, transaction):
+    _write_string(out, transaction['sender'])
+    _write_string(out, transaction['recipient'])
+    _write_string(out, transaction['signature'])
+    _write_number(out, transaction['amount'])
+
+
+def _read_transaction(data, offset, version=VERSION):
+    sender, offset = _read_string(data, offset)
+    recipient, offset = _read_string(data, offset)
+    signature, offset = _read_string(data, offset)
+    amount, offset = _read_number(data, offset)
+    return {'sender': sender, 'recipient': recipient, 'signature': signature, 'amount': amount}, offset
+
+
+def _write_block(out, block):
+    _write_number(out, block['index'])
+    _write_string(out, block['previous_hash'])
+    _write_number(out, block['timestamp'])
+    _write_number(out, block['proof'])
+    _write_varint(out, len(block['transactions']))
+    for transaction in block['transactions']:
+        _write_transaction(out, transaction)
+    # The cached hash and the merkle root are optional
+    _write_string(out, block.get('hash') or '')
+    _write_string(out, block.get('merkle_root') or '')
+
+
+def _read_block(data, offset, version=VERSION):
+    index, offset = _read_number(data, offset)
+    previous_hash, offset = _read_string(data, offset)
+    timestamp, offset = _read_number(data, offset)
+    proof, offset = _read_number(data, offset)
+    count, offset = _read_varint(data, offset)
+    transactions = []
+    for _ in range(count):
+        transaction, offset = _read_transaction(data, offset)
+        transactions.append(transaction)
+    block_hash, offset = _read_string(data, offset)
+    root = ''
+    if version >= 2:
+        root, offset = _read_string(data, offset)
+    block = {'index': index, 'previous_hash': previous_hash, 'timestamp': timestamp,
+             'transactions': transactions, 'proof': proof}
+    if block_hash:
+        block['hash'] = block_hash
+    if root:
+        block['merkle_root'] = root
+    return block, offset
+
+
+def _encode(kind, write, value):
+    out = bytearray((VERSION, kind))
+    try:
+        write(out, value)
+    except (AttributeError, KeyError, TypeError, struct.error) as error:
+        raise ValueError('The value can not be encoded') from error
+    return bytes(out)
+
+
+def _decode(kind, read, data):
+    try:
+        if data[0] not in SUPPORTED_VERSIONS or data[1] != kind:
+            raise ValueError('Unsupported encoding version or kind')
+        value, offset = read(data, 2, data[0])
+    except (IndexError, struct.error, UnicodeDecodeError) as error:
+        raise ValueError('Malformed binary data') from error
+    if offset != len(data):
+        raise ValueError('Trailing bytes after the encoded value')
+    return value
+
+
+def encode_transaction(transaction):
+    """ Encodes the dictionary representation of a transaction, raises ValueError for unsupported values """
+    return _encode(KIND_TRANSACTION, _write_transaction, transaction)
+
+
+def decode_transaction(data):
+    """ Decodes a transaction to its dictionary representation, raises ValueError for malformed data """
+    return _decode(KIND_TRANSACTION, _read_transaction, data)
+
+
+def encode_block(block):
+    """ Encodes the dictionary representation of a block, raises ValueError for unsupported values """
+    return _encode(KIND_BLOCK, _write_block, block)
+
+
+def decode_block(data):
+    """ Decodes a block to its dictionary representation, raises ValueError for malformed data """
+    return _decode(KIND_BLOCK, _read_block, data)
+
+
+def encode_frame(payload):
+    """ Prefixes an encoded value with its varint length, so several can be streamed back to back """
+    out = bytearray()
+    _write_varint(out, len(payload))
+    return bytes(out) + payload
+
+
+def iter_frames(chunks):
+    """ Yields the payloads of length prefixed frames from an iterable of byte chunks,
+    e.g. a streamed HTTP response.
+
+    Arguments:
+        :chunks: The byte chunks in the order they arrive
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        offset = 0
+        while True:
+            try:
+                length, start = _read_varint(buffer, offset)
+            except IndexError:
+                break
+            if start + length > len(buffer):
+                break
+            yield bytes(buffer[start:start + length])
+            offset = start + length
+        del buffer[:offset]
+    if buffer:
+        raise ValueError('Stream ended in the middle of a frame')
@@ -8,6 +8,16 @@ def hash_string_256(string):
     return sha256(string).hexdigest()
 
 
+def hash_prefix_256(prefix):
+    """ Returns a sha256 state which already consumed the given bytes.
+    Copying it hashes many strings sharing that prefix without rehashing the prefix.
+
+    Arguments:
+        :prefix: The bytes every hashed string starts with
+    """
+    return sha256(prefix)
+
+
 def hash_block(block):
     """ Generates a hash of the block by converting the block to 
     an utf-8 JSON string and hashing the string using sha256
@@ -15,8 +25,34 @@ def hash_block(block):
     Arguments:
         :block: The block that should be hashed
     """
-    hashable_block = block.__dict__.copy()
-    hashable_block['transactions'] = [tx.to_ordered_dict()
-                                      for tx in hashable_block['transactions']]
+    # Only the content of the block is hashed, not the cached hash itself
+    if block.merkle_root is not None:
+        # The merkle root commits to the transactions, so only the header has to be hashed
+        hashable_block = {
+            'index': block.index,
+            'previous_hash': block.previous_hash,
+            'timestamp': block.timestamp,
+            'merkle_root': block.merkle_root,
+            'proof': block.proof
+        }
+        return sha256(dumps(hashable_block, sort_keys=True).encode()).hexdigest()
+    hashable_block = {
+        'index': block.index,
+        'previous_hash': block.previous_hash,
+        'timestamp': block.timestamp,
+        'transactions': [tx.to_ordered_dict() for tx in block.transactions],
+        'proof': block.proof
+    }
     # sort_keys ensures that the keys are always sorted and hence the hash never changes for the same block
     return sha256(dumps(hashable_block, sort_keys=True).encode()).hexdigest()
+
+
+def hash_transaction(transaction):
+    """ Generates the canonical id of a transaction from its sender, recipient, amount and signature
+
+    Arguments:
+        :transaction: The transaction that should be hashed
+    """
+    # The amount is kept as it was signed, i.e. 1 and 1.0 are different transactions
+    return sha256(dumps([transaction.sender, transaction.recipient, str(transaction.amount),
+                         transaction.signature]).encode()).hexdigest()
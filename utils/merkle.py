@@ -0,0 +1,108 @@
+""" Provides merkle roots over the transactions of a block and inclusion proofs for them
+
+Leaves are the transaction ids (see hash_transaction), inner nodes the sha256 of the
+concatenated raw child hashes. A level with an odd number of nodes pairs its last node with itself.
+"""
+
+from hashlib import sha256
+
+
+def _hash_pair(left, right):
+    return sha256(left + right).digest()
+
+
+class MerkleBuilder:
+    """ Computes a merkle root incrementally while transactions are appended,
+    only keeping one subtree hash per level in memory.
+    """
+
+    def __init__(self):
+        # The roots of the complete subtrees built so far, by level
+        self.__subtrees = []
+
+    def add(self, tx_id):
+        """ Appends a leaf
+
+        Arguments:
+            :tx_id: The hex encoded id of the transaction
+        """
+        node = bytes.fromhex(tx_id)
+        level = 0
+        while level < len(self.__subtrees) and self.__subtrees[level] is not None:
+            node = _hash_pair(self.__subtrees[level], node)
+            self.__subtrees[level] = None
+            level += 1
+        if level == len(self.__subtrees):
+            self.__subtrees.append(node)
+        else:
+            self.__subtrees[level] = node
+
+    def root(self):
+        """ Returns the hex encoded merkle root of the leaves added so far ('' without leaves) """
+        node = None
+        top = len(self.__subtrees) - 1
+        for level, subtree in enumerate(self.__subtrees):
+            if node is None:
+                if subtree is None:
+                    continue
+                if level == top:
+                    return subtree.hex()
+                # The last subtree has no sibling on its level, so it is paired with itself
+                node = _hash_pair(subtree, subtree)
+            elif subtree is not None:
+                node = _hash_pair(subtree, node)
+            else:
+                node = _hash_pair(node, node)
+        return node.hex() if node is not None else ''
+
+
+def merkle_root(tx_ids):
+    """ Returns the hex encoded merkle root of a list of transaction ids
+
+    Arguments:
+        :tx_ids: The hex encoded ids of the transactions
+    """
+    builder = MerkleBuilder()
+    for tx_id in tx_ids:
+        builder.add(tx_id)
+    return builder.root()
+
+
+def merkle_proof(tx_ids, position):
+    """ Returns the sibling hashes needed to recompute the merkle root from one transaction,
+    from the leaf level upwards, each with the side it is on.
+
+    Arguments:
+        :tx_ids: The hex encoded ids of all transactions of the block
+        :position: The position of the transaction in the block
+    """
+    level = [bytes.fromhex(tx_id) for tx_id in tx_ids]
+    proof = []
+    while len(level) > 1:
+        if len(level) % 2 == 1:
+            level.append(level[-1])
+        sibling = position ^ 1
+        proof.append({'hash': level[sibling].hex(),
+                      'side': 'left' if sibling < position else 'right'})
+        level = [_hash_pair(level[i], level[i + 1])
+                 for i in range(0, len(level), 2)]
+        position //= 2
+    return proof
+
+
+def verify_merkle_proof(tx_id, proof, root):
+    """ Checks that a transaction is part of the block with the given merkle root
+
+    Arguments:
+        :tx_id: The hex encoded id of the transaction
+        :proof: The proof as returned by merkle_proof
+        :root: The hex encoded merkle root of the block
+    """
+    node = bytes.fromhex(tx_id)
+    for step in proof:
+        sibling = bytes.fromhex(step['hash'])
+        if step['side'] == 'left':
+            node = _hash_pair(sibling, node)
+        else:
+            node = _hash_pair(node, sibling)
+    return node.hex() == root
@@ -0,0 +1,220 @@
+""" Provides counters, latency histograms and gauges which are exposed in the Prometheus text format """
+
+from bisect import bisect_left
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """ A value which only goes up, e.g. the number of mined blocks
+
+    Attributes:
+        :name: The metric name, ending with _total
+        :help: The description of the metric
+        :label_names: The names of the labels every value is recorded with
+    """
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.__values = {}
+        self.__lock = Lock()
+
+    def inc(self, *label_values, amount=1):
+        """ Increases the counter
+
+        Arguments:
+            :label_values: The values of the labels, in the order of label_names
+            :amount: The amount to add
+        """
+        with self.__lock:
+            self.__values[label_values] = self.__values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.__lock:
+            values = list(self.__values.items())
+        if not values and not self.label_names:
+            values = [((), 0)]
+        for label_values, value in values:
+            lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """ Counts observed values, e.g. latencies in seconds, in cumulative buckets
+
+    Attributes:
+        :name: The metric name, ending with the unit, e.g. _seconds
+        :help: The description of the metric
+        :label_names: The names of the labels every observation is recorded with
+        :buckets: The upper bounds of the buckets
+    """
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # Per label values: the count of every bucket (the last one is +Inf), the sum and the count
+        self.__values = {}
+        self.__lock = Lock()
+
+    def observe(self, value, *label_values):
+        """ Records one observation
+
+        Arguments:
+            :value: The observed value
+            :label_values: The values of the labels, in the order of label_names
+        """
+        bucket = bisect_left(self.buckets, value)
+        with self.__lock:
+            counts = self.__values.get(label_values)
+            if counts is None:
+                counts = self.__values[label_values] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0]
+            counts[0][bucket] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def time(self, *label_values):
+        """ Returns a timer observing the seconds a block or every call of a function takes,
+        it's used either as a context manager or as a decorator
+
+        Arguments:
+            :label_values: The values of the labels, in the order of label_names
+        """
+        return _Timer(self, label_values)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.__lock:
+            values = [(label_values, list(counts[0]), counts[1], counts[2])
+                      for label_values, counts in self.__values.items()]
+        for label_values, bucket_counts, total, count in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, label_values, [('le', _format_value(bound))])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self.__histogram = histogram
+        self.__label_values = label_values
+
+    def __enter__(self):
+        self.__start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__histogram.observe(perf_counter() - self.__start, *self.__label_values)
+        return False
+
+    def __call__(self, function):
+        # The start time is kept per call, so the decorated function may run in several threads at once
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.__histogram.observe(perf_counter() - start, *self.__label_values)
+        return wrapper
+
+
+class CallbackMetric:
+    """ A value which is read when the metrics are collected, e.g. the chain height
+
+    Attributes:
+        :name: The metric name
+        :help: The description of the metric
+        :type: 'gauge' or 'counter'
+    """
+
+    def __init__(self, name, help, function, type='gauge'):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.__function = function
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        try:
+            value = self.__function()
+        except Exception:
+            # A failing callback must not break the whole scrape
+            return lines
+        if value is not None:
+            lines.append(f'{self.name} {_format_value(value)}')
+        return lines
+
+
+class MetricsRegistry:
+    """ Holds all metrics of the node, registering a name twice returns the existing metric """
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__lock = Lock()
+
+    def __register(self, metric):
+        with self.__lock:
+            return self.__metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, label_names=()):
+        return self.__register(Counter(name, help, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.__register(Histogram(name, help, label_names, buckets))
+
+    def gauge(self, name, help, function):
+        """ Registers a gauge whose value is returned by a function, replacing an earlier one
+
+        Arguments:
+            :name: The metric name
+            :help: The description of the metric
+            :function: Function returning the current value
+        """
+        metric = CallbackMetric(name, help, function)
+        with self.__lock:
+            self.__metrics[name] = metric
+        return metric
+
+    def render(self):
+        """ Returns all metrics in the Prometheus text exposition format """
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,18 @@
+""" Provides the start method and timeout shared by the worker process pools """
+
+import multiprocessing
+
+# Seconds without any finished task after which a worker process pool is given up
+POOL_TIMEOUT = 60
+
+
+def pool_context():
+    """ Returns the multiprocessing context the worker process pools are started with.
+
+    The node serves requests in several threads, a forked worker would inherit locks held by
+    other threads at that moment (e.g. of the signature cache) and wait for them forever.
+    The workers are therefore started by a fork server, or spawned where there is none.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
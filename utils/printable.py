@@ -2,5 +2,8 @@
 
 
 class Printable:
+    # Subclasses may use __slots__, so the base class mustn't add a __dict__
+    __slots__ = ()
+
     def __repr__(self):
-        return str(self.__dict__)
+        return str(self.to_dict())
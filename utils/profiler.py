@@ -0,0 +1,159 @@
+""" Provides opt-in profiling of requests and mining runs with cProfile """
+
+from collections import deque
+from contextlib import contextmanager
+import cProfile
+import os
+import pstats
+import random
+from threading import Lock
+from time import time_ns
+
+# Header asking for a single request to be profiled
+PROFILE_HEADER = 'X-Profile'
+# Maximum number of profile dumps kept in the profile directory
+PROFILE_MAX_FILES = 100
+# Default number of functions listed in a summary
+PROFILE_TOP = 25
+
+
+class Profiler:
+    """ Profiles requests and mining runs while it's enabled and writes every profile to its own file,
+    which can be opened with pstats or snakeviz. The oldest files are deleted once there are too many.
+    All profiles are also added up in memory for the summary of the slowest functions.
+
+    Profiling is off until configure is called, checking the enabled attribute is all it costs then.
+
+    Attributes:
+        :enabled: Whether requests asking for it (see PROFILE_HEADER) or sampled ones are profiled
+        :sample_rate: The share of requests and mining runs profiled without being asked for, 0 to 1
+        :directory: The directory the profile dumps are written to
+        :max_files: The maximum number of profile dumps kept
+        :profiled: The number of profiles taken
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.directory = None
+        self.max_files = PROFILE_MAX_FILES
+        self.profiled = 0
+        self.__files = deque()
+        self.__stats = None
+        self.__lock = Lock()
+
+    def configure(self, directory, sample_rate=0.0, max_files=PROFILE_MAX_FILES):
+        """ Enables profiling
+
+        Arguments:
+            :directory: The directory the profile dumps are written to
+            :sample_rate: The share of requests and mining runs profiled without being asked for
+            :max_files: The maximum number of profile dumps kept
+        """
+        os.makedirs(directory, exist_ok=True)
+        with self.__lock:
+            self.directory = directory
+            self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+            self.max_files = max_files
+            # Dumps of earlier runs count towards the limit, their names sort by creation time
+            self.__files = deque(sorted(
+                os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.prof')))
+            self.enabled = True
+        self.__prune()
+
+    def should_profile(self, requested=False):
+        """ Decides whether the next request or mining run is profiled
+
+        Arguments:
+            :requested: Whether the request asked to be profiled
+        """
+        return self.enabled and (requested or (self.sample_rate > 0 and random.random() < self.sample_rate))
+
+    def start(self):
+        """ Starts profiling the current thread and returns the profile,
+        or None if the thread is profiled already
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Only one profiler can run at a time on interpreters profiling all threads at once
+            return None
+        return profile
+
+    def stop(self, profile, name):
+        """ Stops a profile, writes it to the profile directory and adds it to the summary
+
+        Arguments:
+            :profile: The profile returned by start
+            :name: The name of the profiled operation, e.g. 'GET-get_chain'
+        """
+        profile.disable()
+        file_path = os.path.join(self.directory, f'{time_ns()}-{name}.prof')
+        try:
+            profile.dump_stats(file_path)
+        except IOError:
+            print('Saving failed')
+            file_path = None
+        with self.__lock:
+            if self.__stats is None:
+                self.__stats = pstats.Stats(profile)
+            else:
+                self.__stats.add(profile)
+            if file_path is not None:
+                self.__files.append(file_path)
+            self.profiled += 1
+        self.__prune()
+
+    @contextmanager
+    def profile(self, name, requested=False):
+        """ Profiles the block if profiling is enabled and the run is requested or sampled
+
+        Arguments:
+            :name: The name of the profiled operation, e.g. 'mine_block'
+            :requested: Whether the run asked to be profiled
+        """
+        profile = self.start() if self.should_profile(requested) else None
+        try:
+            yield
+        finally:
+            if profile is not None:
+                self.stop(profile, name)
+
+    def __prune(self):
+        with self.__lock:
+            old_files = [self.__files.popleft() for _ in range(len(self.__files) - self.max_files)]
+        for file_path in old_files:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def summary(self, top=PROFILE_TOP, sort='cumulative'):
+        """ Returns the functions which took the most time over all profiles
+
+        Arguments:
+            :top: The number of functions listed
+            :sort: 'cumulative' to include the time spent in called functions, 'tottime' to exclude it
+        """
+        with self.__lock:
+            files = [os.path.basename(file_path) for file_path in self.__files]
+            entries = list(self.__stats.stats.items()) if self.__stats is not None else []
+        # Each entry maps (file, line, function) to (primitive calls, calls, own time, cumulative time, callers)
+        position = 2 if sort == 'tottime' else 3
+        entries.sort(key=lambda entry: entry[1][position], reverse=True)
+        return {
+            'enabled': self.enabled,
+            'sample_rate': self.sample_rate,
+            'profiled': self.profiled,
+            'files': files,
+            'functions': [{
+                'function': f'{file_name}:{line}({function})',
+                'calls': calls,
+                'total_time': total_time,
+                'cumulative_time': cumulative_time
+            } for (file_name, line, function), (_, calls, total_time, cumulative_time, _) in entries[:top]]
+        }
+
+
+profiler = Profiler()
@@ -0,0 +1,109 @@
+""" Provides a cache of transactions whose signature was already verified """
+
+from collections import OrderedDict
+from threading import Lock
+
+# Number of verified transaction ids kept in memory
+SIGNATURE_CACHE_SIZE = 100000
+
+
+class SignatureCache:
+    """ A bounded LRU set of the ids of transactions with a valid signature.
+
+    Only valid signatures are remembered, so a cached id never has to be checked again.
+    New ids are appended to a sidecar file, which is compacted once it grows
+    to twice the cache size, so the cache survives restarts.
+
+    Attributes:
+        :max_size: The maximum number of ids kept
+        :hits: The number of lookups which found the id
+        :misses: The number of lookups which didn't find the id
+    """
+
+    def __init__(self, max_size=SIGNATURE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__verified = OrderedDict()
+        self.__unsaved = []
+        self.__file_path = None
+        self.__file_lines = 0
+        self.__lock = Lock()
+
+    def __len__(self):
+        return len(self.__verified)
+
+    def is_verified(self, tx_id):
+        """ Checks whether the signature of a transaction was already verified
+
+        Arguments:
+            :tx_id: The id of the transaction (see hash_transaction)
+        """
+        with self.__lock:
+            if tx_id in self.__verified:
+                self.__verified.move_to_end(tx_id)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, tx_id):
+        """ Remembers a transaction whose signature is valid
+
+        Arguments:
+            :tx_id: The id of the transaction (see hash_transaction)
+        """
+        with self.__lock:
+            if tx_id in self.__verified:
+                return
+            self.__verified[tx_id] = True
+            self.__unsaved.append(tx_id)
+            if len(self.__verified) > self.max_size:
+                self.__verified.popitem(last=False)
+
+    def clear(self):
+        """ Forgets all ids kept in memory, e.g. to measure verifying signatures which aren't cached """
+        with self.__lock:
+            self.__verified.clear()
+            self.__unsaved = []
+
+    def load(self, file_path):
+        """ Loads the ids saved by a previous run and saves new ids to the same file
+
+        Arguments:
+            :file_path: The path of the sidecar file
+        """
+        with self.__lock:
+            self.__file_path = file_path
+            self.__file_lines = 0
+            try:
+                with open(file_path, mode='r') as f:
+                    for line in f:
+                        self.__file_lines += 1
+                        self.__verified[line.rstrip('\n')] = True
+                        if len(self.__verified) > self.max_size:
+                            self.__verified.popitem(last=False)
+            except IOError:
+                pass
+
+    def save(self):
+        """ Appends the ids verified since the last save to the sidecar file """
+        with self.__lock:
+            if self.__file_path is None or not self.__unsaved:
+                return
+            try:
+                if self.__file_lines + len(self.__unsaved) > 2 * self.max_size:
+                    with open(self.__file_path, mode='w') as f:
+                        f.writelines(f'{tx_id}\n' for tx_id in self.__verified)
+                    self.__file_lines = len(self.__verified)
+                else:
+                    with open(self.__file_path, mode='a') as f:
+                        f.writelines(f'{tx_id}\n' for tx_id in self.__unsaved)
+                    self.__file_lines += len(self.__unsaved)
+                self.__unsaved = []
+            except IOError:
+                print('Saving verified transactions failed')
+
+
+# Shared by the mempool, the miner and the chain verifier of this node
+signature_cache = SignatureCache()
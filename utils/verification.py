@@ -1,31 +1,147 @@
 """ Provides verification helper methods """
 
-from utils.hash_util import hash_block, hash_string_256
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from utils.hash_util import hash_prefix_256, hash_transaction
+from utils.merkle import merkle_root
+from utils.pool import POOL_TIMEOUT, pool_context
+from utils.signature_cache import signature_cache
 from wallet import Wallet
 
 
+# Number of consecutive blocks a worker process checks per task
+VERIFY_CHUNK = 64
+
+
+def find_invalid_in_chunk(previous_block, blocks, start_height, verified_ids=()):
+    """ Checks a run of consecutive blocks in a worker process.
+    Returns the height of the first invalid block (or None) and the ids of the
+    transactions verified on the way, so they can be added to the parent's signature cache.
+
+    Arguments:
+        :previous_block: The block right before the run
+        :blocks: The blocks to check
+        :start_height: The height of the first block of the run
+        :verified_ids: The ids of transactions whose signature the parent verified before
+    """
+    # A worker process starts with an empty signature cache
+    for tx_id in verified_ids:
+        signature_cache.add(tx_id)
+    verified_ids = []
+    for height, block in enumerate(blocks, start_height):
+        if not Verification.verify_block(block, previous_block):
+            return height, verified_ids
+        verified_ids.extend(hash_transaction(tx)
+                            for tx in block.transactions[:-1])
+        previous_block = block
+    return None, verified_ids
+
+
 class Verification:
-    # Class method because it accesses valid_proof
+    # Class method because it accesses find_invalid_block
     @classmethod
-    def verify_chain(cls, blockchain):
-        """ Verify the current blockchain """
-        is_valid = True
+    def verify_chain(cls, blockchain, workers=None):
+        """ Verify the current blockchain
 
-        for index, block in enumerate(blockchain):
-            if index == 0:
-                continue
-            # Checking previous hash
-            elif block.previous_hash == hash_block(blockchain[index - 1]):
+        Arguments:
+            :blockchain: The list of blocks
+            :workers: The number of processes to verify with (defaults to the number of cores)
+        """
+        return cls.find_invalid_block(blockchain, workers) is None
+
+    @staticmethod
+    def find_invalid_block(blockchain, workers=None):
+        """ Returns the height of the first invalid block or None if the chain is valid.
+
+        Long chains are split into chunks, the ones with signatures which weren't verified before
+        are checked in a process pool, chunks after the first invalid one found are cancelled.
+        Raises a TimeoutError if no chunk is finished within POOL_TIMEOUT seconds.
+
+        Arguments:
+            :blockchain: The list of blocks
+            :workers: The number of processes to verify with (defaults to the number of cores)
+        """
+        if not blockchain[0].verify_hash():
+            return 0
+        if len(blockchain) < 2:
+            return None
+        if len(blockchain) <= VERIFY_CHUNK or workers == 1:
+            return find_invalid_in_chunk(blockchain[0], blockchain[1:], 1)[0]
+
+        first_invalid = None
+        # Chunks whose signatures are all in the signature cache only need hashing, which is done here,
+        # the others go to the pool together with the ids of their signatures verified before
+        remote_chunks = []
+        for start in range(1, len(blockchain), VERIFY_CHUNK):
+            previous_block = blockchain[start - 1]
+            blocks = blockchain[start:start + VERIFY_CHUNK]
+            tx_ids = [hash_transaction(tx) for block in blocks for tx in block.transactions[:-1]]
+            verified_ids = [tx_id for tx_id in tx_ids if signature_cache.is_verified(tx_id)]
+            if len(verified_ids) < len(tx_ids):
+                remote_chunks.append((previous_block, blocks, start, verified_ids))
                 continue
-            # Checking proof of work
-            elif not cls.valid_proof(block.transactions[:-1], block.previous_hash, block.proof):
-                is_valid = False
-                break
-            else:
-                is_valid = False
+            first_invalid = find_invalid_in_chunk(previous_block, blocks, start)[0]
+            if first_invalid is not None:
+                # Only chunks before the invalid block can still change the result
                 break
+        if not remote_chunks:
+            return first_invalid
+
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=pool_context())
+        try:
+            futures = {executor.submit(find_invalid_in_chunk, previous_block, blocks, start, verified_ids): start
+                       for previous_block, blocks, start, verified_ids in remote_chunks}
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=POOL_TIMEOUT, return_when=FIRST_COMPLETED)
+                if not done:
+                    raise TimeoutError(f'No chunk of the chain was verified within {POOL_TIMEOUT} seconds')
+                for future in done:
+                    if future.cancelled():
+                        continue
+                    invalid_height, verified_ids = future.result()
+                    for tx_id in verified_ids:
+                        signature_cache.add(tx_id)
+                    if invalid_height is not None and (first_invalid is None or invalid_height < first_invalid):
+                        first_invalid = invalid_height
+                        # Only chunks before the invalid block can still change the result
+                        for later, start in futures.items():
+                            if start > invalid_height:
+                                later.cancel()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
-        return is_valid
+        return first_invalid
+
+    @staticmethod
+    def verify_block(block, previous_block):
+        """ Checks the link to the previous block, the hash, the merkle root, the proof of work
+        and all signatures of a block.
+        The cached hash of the previous block is expected to be verified already.
+
+        Arguments:
+            :block: The block to check
+            :previous_block: The block before it in the chain
+        """
+        if block.index != previous_block.index + 1 or block.previous_hash != previous_block.hash:
+            return False
+        # A hash received from a peer has to match the content of the block
+        if not block.verify_hash():
+            return False
+        # The hash only covers the merkle root, which in turn has to match the transactions
+        if block.merkle_root is not None and block.merkle_root != merkle_root(
+                [hash_transaction(tx) for tx in block.transactions]):
+            return False
+        # The mining reward is the last transaction and not part of the proof of work
+        if not block.transactions or block.transactions[-1].sender != 'MINING':
+            return False
+        if not Verification.valid_proof(block.transactions[:-1], block.previous_hash, block.proof):
+            return False
+        if any(tx.sender == 'MINING' for tx in block.transactions[:-1]):
+            return False
+        if not all(Verification.verify_fields(tx) for tx in block.transactions):
+            return False
+        return all(Wallet.verify_transactions(block.transactions[:-1]))
 
     @staticmethod
     def verify_transaction(transaction, get_balance, check_funds=True):
@@ -34,16 +150,38 @@ class Verification:
         Arguments:
             :transaction: The transaction to be verified
         """
+        if not Verification.verify_fields(transaction):
+            return False
         if check_funds:
             sender_balance = get_balance(transaction.sender)
             return sender_balance >= transaction.amount and Wallet.verify_transaction(transaction)
         else:
             return Wallet.verify_transaction(transaction)
 
-    # Class method because it accesses verify_transaction
-    @classmethod
-    def verify_transactions(cls, open_transactions, get_balance):
-        return all([cls.verify_transaction(tx, get_balance, False) for tx in open_transactions])
+    @staticmethod
+    def verify_fields(transaction):
+        """ Checks that the fields of a transaction can be stored, i.e. the sender, recipient and signature
+        are strings and the amount is an int or float, where an int has to fit into 64 bits (see utils.codec)
+
+        Arguments:
+            :transaction: The transaction to be checked
+        """
+        if not all(isinstance(field, str) for field in (transaction.sender, transaction.recipient, transaction.signature)):
+            return False
+        # bool is a subclass of int, but isn't a number for the codec
+        if type(transaction.amount) is int:
+            return -2 ** 63 <= transaction.amount < 2 ** 63
+        return type(transaction.amount) is float
+
+    @staticmethod
+    def verify_transactions(open_transactions, get_balance, workers=None):
+        """ Verifies the signatures of all open transactions in one batch
+
+        Arguments:
+            :open_transactions: The transactions to be verified
+            :workers: The number of processes to verify with (default: verify in this process)
+        """
+        return all(Wallet.verify_transactions(open_transactions, workers))
 
     @staticmethod
     def valid_proof(transactions, last_hash, proof):
@@ -55,8 +193,32 @@ class Verification:
             :proof: The number to check if it is a valid proof
         """
 
-        guess = (str([tx.to_ordered_dict() for tx in transactions]) +
-                 str(last_hash) + str(proof)).encode()
-        guess_hash = hash_string_256(guess)
+        guess_prefix = Verification.proof_prefix(transactions, last_hash)
+
+        return Verification.valid_guess(hash_prefix_256(guess_prefix), proof)
+
+    @staticmethod
+    def proof_prefix(transactions, last_hash):
+        """ Returns the encoded part of the proof of work guess which doesn't depend on the proof
+
+        Arguments:
+            :transactions: The list of transactions
+            :last_hash: The hash of the previous block
+        """
+        return (str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash)).encode()
+
+    @staticmethod
+    def valid_guess(prefix_hash, proof):
+        """ To check whether a proof generates a valid hash, appending only the proof
+        to a sha256 state which already consumed the guess prefix.
+
+        A hex digest starting with '00' is the same as a first digest byte of 0.
+
+        Arguments:
+            :prefix_hash: The sha256 state fed with the output of proof_prefix
+            :proof: The number to check if it is a valid proof
+        """
+        guess_hash = prefix_hash.copy()
+        guess_hash.update(str(proof).encode())
 
-        return guess_hash[0: 2] == '00'
+        return guess_hash.digest()[0] == 0
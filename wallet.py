@@ -3,6 +3,22 @@ from Crypto.Signature import PKCS1_v1_5
 from Crypto.Hash import SHA256
 import Crypto.Random
 import binascii
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from utils.hash_util import hash_transaction
+from utils.metrics import metrics
+from utils.pool import POOL_TIMEOUT, pool_context
+from utils.signature_cache import signature_cache
+
+# Number of parsed public keys kept in memory
+KEY_CACHE_SIZE = 1024
+# Number of transactions sent to a worker process at once when verifying a batch
+VERIFY_BATCH_CHUNK = 64
+
+# Latency of single signature checks, including the ones found in the signature cache
+VERIFY_TRANSACTION_SECONDS = metrics.histogram(
+    'wallet_verify_transaction_seconds', 'Seconds spent verifying the signature of a single transaction')
 
 
 class Wallet:
@@ -59,10 +75,83 @@ class Wallet:
         return binascii.hexlify(signature).decode('ascii')
 
     @staticmethod
+    @VERIFY_TRANSACTION_SECONDS.time()
     def verify_transaction(transaction):
-        public_key = RSA.importKey(binascii.unhexlify(transaction.sender))
-        verifier = PKCS1_v1_5.new(public_key)
+        """ Verifies the signature of a transaction unless it was verified before
+
+        Arguments:
+            :transaction: The transaction to verify
+        """
+        tx_id = hash_transaction(transaction)
+        if signature_cache.is_verified(tx_id):
+            return True
+
+        is_valid = verify_signature(transaction)
+        if is_valid:
+            signature_cache.add(tx_id)
+        return is_valid
+
+    @staticmethod
+    def verify_transactions(transactions, workers=None):
+        """ Verifies the signatures of a list of transactions at once.
+        Returns a list with the result for every transaction.
+
+        Arguments:
+            :transactions: The transactions to verify
+            :workers: The number of processes to verify with (default: verify in this process)
+        Raises a TimeoutError if the worker processes don't finish within POOL_TIMEOUT seconds.
+        """
+        if workers is None or workers <= 1 or len(transactions) < VERIFY_BATCH_CHUNK:
+            return [Wallet.verify_transaction(tx) for tx in transactions]
+
+        tx_ids = [hash_transaction(tx) for tx in transactions]
+        results = [signature_cache.is_verified(tx_id) for tx_id in tx_ids]
+        unverified = [index for index, is_valid in enumerate(
+            results) if not is_valid]
+
+        # Only signatures which were never verified are sent to the worker processes
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=pool_context())
+        try:
+            checked = executor.map(verify_signature, [transactions[index] for index in unverified],
+                                   timeout=POOL_TIMEOUT, chunksize=VERIFY_BATCH_CHUNK)
+            for index, is_valid in zip(unverified, checked):
+                results[index] = is_valid
+                if is_valid:
+                    signature_cache.add(tx_ids[index])
+        finally:
+            # Waiting for the workers would hang if they timed out
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return results
+
+    @staticmethod
+    def key_cache_info():
+        """ Returns the hits, misses, maximum size and current size of the public key cache """
+        return load_verifier.cache_info()
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def load_verifier(public_key):
+    """ Parses a hex encoded public key once and returns a reusable signature verifier for it
+
+    Arguments:
+        :public_key: The hex encoded DER public key
+    """
+    return PKCS1_v1_5.new(RSA.importKey(binascii.unhexlify(public_key)))
+
+
+def verify_signature(transaction):
+    """ Checks the RSA signature of a transaction, bypassing the signature cache
+
+    Arguments:
+        :transaction: The transaction to verify
+    """
+    try:
+        verifier = load_verifier(transaction.sender)
         h = SHA256.new((str(transaction.sender) + str(transaction.recipient) +
                         str(transaction.amount)).encode('utf8'))
 
         return verifier.verify(h, binascii.unhexlify(transaction.signature))
+    except (ValueError, TypeError, IndexError, binascii.Error):
+        # Malformed keys or signatures can't be valid
+        return False
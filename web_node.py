@@ -1,13 +1,113 @@
-from flask import Flask, jsonify, request, send_from_directory
+import json
+
+from flask import Flask, Response, g, jsonify, request, send_from_directory
 from flask_cors import CORS
 
 from wallet import Wallet
-from blockchain import Blockchain
-
+from blockchain import Blockchain, SYNC_MAX_PAGE
+from transaction import Transaction
+from broadcast import BROADCAST_TIMEOUT
+from utils.codec import CONTENT_TYPE, decode_block, decode_transaction, encode_block, encode_frame
+from utils.hash_util import hash_transaction
+from utils.merkle import merkle_proof
+from utils.metrics import metrics
+from utils.profiler import PROFILE_HEADER, PROFILE_TOP, profiler
+
+
+# Default and maximum number of transactions returned per page of an address history
+ADDRESS_PAGE_SIZE = 50
+ADDRESS_MAX_PAGE = 500
+# Maximum number of transactions submitted in one batch
+TRANSACTION_BATCH_MAX = 1000
 
 app = Flask(__name__)
 CORS(app)
 
+# The gauges are read from the current blockchain whenever the metrics are collected
+metrics.gauge('blockchain_height', 'Number of blocks in the chain',
+              lambda: blockchain.height())
+metrics.gauge('mempool_transactions', 'Number of open transactions',
+              lambda: len(blockchain.get_open_transactions()))
+metrics.gauge('peer_nodes', 'Number of peer nodes',
+              lambda: len(blockchain.get_peer_nodes()))
+metrics.gauge('peer_nodes_healthy', 'Number of peer nodes which answered their last requests',
+              lambda: sum(peer['status'] == 'healthy' for peer in blockchain.peers.stats()))
+metrics.gauge('miner_hash_rate', 'Hashes per second of the last proof of work search',
+              lambda: sum(blockchain.miner.hash_rates.values()))
+
+
+@app.before_request
+def start_profile():
+    # Nothing else is done while profiling is off
+    if profiler.enabled and profiler.should_profile(PROFILE_HEADER in request.headers):
+        g.profile = profiler.start()
+
+
+@app.after_request
+def stop_profile_on_close(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        name = f'{request.method}-{request.endpoint}'
+        # Streamed bodies like the one of /chain are generated after the request is torn down,
+        # so the profile only ends once the response is sent
+        response.call_on_close(lambda: profiler.stop(profile, name))
+    return response
+
+
+@app.teardown_request
+def stop_profile(exception):
+    # Only still running if no response was made
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profiler.stop(profile, f'{request.method}-{request.endpoint}')
+
+
+def get_batch_items():
+    """ Returns the list of transactions of a batch request and None or an error response """
+    values = request.get_json(silent=True)
+    items = values.get('transactions') if isinstance(values, dict) else values
+    if not isinstance(items, list) or not items:
+        return None, (jsonify({'message': 'No transactions'}), 400)
+    if len(items) > TRANSACTION_BATCH_MAX:
+        response = {'message': f'At most {TRANSACTION_BATCH_MAX} transactions per batch'}
+        return None, (jsonify(response), 413)
+    return items, None
+
+
+def add_batch(items, to_transaction, is_receiving):
+    """ Adds the valid items of a batch and returns the result of every item
+
+    Arguments:
+        :items: The transaction dictionaries of the request
+        :to_transaction: Function returning the transaction of an item, or None if data is missing
+        :is_receiving: Whether the batch was relayed by a peer
+    """
+    transactions = [to_transaction(item) if isinstance(item, dict) else None for item in items]
+    valid = [tx for tx in transactions if tx is not None]
+    added = iter(blockchain.add_transactions(valid, is_receiving))
+    results = []
+    for tx in transactions:
+        if tx is None:
+            results.append({'transaction': None, 'added': False, 'message': 'Required data is missing'})
+        else:
+            is_added, message = next(added)
+            results.append({'transaction': tx.to_dict(), 'added': is_added, 'message': message})
+    return results
+
+
+def get_request_values(decode):
+    """ Returns the body of a request, decoding it if a peer sent the binary encoding
+
+    Arguments:
+        :decode: Function decoding the binary body
+    """
+    if request.mimetype == CONTENT_TYPE:
+        try:
+            return decode(request.get_data())
+        except ValueError:
+            return None
+    return request.get_json()
+
 
 @app.route('/wallet', methods=['POST'])
 def create_keys():
@@ -17,8 +117,8 @@ def create_keys():
     status_code = 201
 
     if wallet.save_keys():
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        # A second Blockchain on the same store would write over the blocks of this one
+        blockchain.set_public_key(wallet.public_key)
 
         response = {
             'public_key': wallet.public_key,
@@ -40,8 +140,7 @@ def load_keys():
     status_code = 201
 
     if wallet.load_keys():
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        blockchain.set_public_key(wallet.public_key)
 
         response = {
             'public_key': wallet.public_key,
@@ -81,7 +180,7 @@ def get_balance():
 
 @app.route('/broadcast-transaction', methods=['POST'])
 def broadcast_transaction():
-    values = request.get_json()
+    values = get_request_values(decode_transaction)
     if not values:
         response = {'message': 'No data'}
         return jsonify(response), 400
@@ -91,6 +190,11 @@ def broadcast_transaction():
         response = {'message': 'Some data is missing'}
         return jsonify(response), 400
 
+    if blockchain.has_open_transaction(Transaction(
+            values['sender'], values['recipient'], values['signature'], values['amount'])):
+        response = {'message': 'Duplicate transaction'}
+        return jsonify(response), 409
+
     success = blockchain.add_transaction(
         values['recipient'], values['sender'], values['signature'], values['amount'], is_receiving=True)
 
@@ -114,9 +218,32 @@ def broadcast_transaction():
         return jsonify(response), 500
 
 
+@app.route('/broadcast-transaction/batch', methods=['POST'])
+def broadcast_transactions():
+    items, error = get_batch_items()
+    if error:
+        return error
+
+    required = ['sender', 'recipient', 'amount', 'signature']
+
+    def to_transaction(values):
+        if not all(key in values for key in required):
+            return None
+        return Transaction(values['sender'], values['recipient'], values['signature'], values['amount'])
+
+    results = add_batch(items, to_transaction, is_receiving=True)
+    added = sum(result['added'] for result in results)
+    response = {
+        'message': f'{added} of {len(results)} transactions added',
+        'results': results
+    }
+    return jsonify(response), 201 if added else 500
+
+
 @app.route('/broadcast-block', methods=['POST'])
 def broadcast_block():
-    values = request.get_json()
+    values = get_request_values(
+        lambda data: {'block': decode_block(data)})
     if not values:
         response = {'message': 'No data'}
         return jsonify(response), 400
@@ -126,14 +253,15 @@ def broadcast_block():
         return jsonify(response), 400
 
     block = values['block']
-    if block['index'] == blockchain.chain[-1].index + 1:
+    tip_index = blockchain.height() - 1
+    if block['index'] == tip_index + 1:
         if blockchain.add_block(block):
             response = {'message': 'Block added'}
             return jsonify(response), 201
         else:
             response = {'message': 'Block invalid'}
             return jsonify(response), 409
-    elif block['index'] > blockchain.chain[-1].index:
+    elif block['index'] > tip_index:
         response = {
             'message': 'Blockchain seems to be differ from local blockchain, block not added'}
         blockchain.resolve_conflicts = True
@@ -146,21 +274,118 @@ def broadcast_block():
 
 @app.route('/transactions', methods=['GET'])
 def get_open_transactions():
-    transactions = [tx.__dict__ for tx in blockchain.get_open_transactions()]
+    transactions = [tx.to_dict() for tx in blockchain.get_open_transactions()]
 
     return jsonify(transactions), 200
 
 
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    chain_snapshot = blockchain.chain
-    dict_chain = [block.__dict__.copy() for block in chain_snapshot]
+    start = max(request.args.get('from', 0, type=int), 0)
+    limit = request.args.get('limit', None, type=int)
+    blocks = blockchain.iter_blocks(start, limit)
+
+    # Blocks are serialized one at a time while the response is sent
+    if CONTENT_TYPE in request.headers.get('Accept', ''):
+        def generate_frames():
+            for block in blocks:
+                yield encode_frame(encode_block(block.to_dict()))
+
+        return Response(generate_frames(), mimetype=CONTENT_TYPE), 200
+
+    if request.args.get('format') == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        def generate_lines():
+            for block in blocks:
+                yield json.dumps(block.to_dict()) + '\n'
+
+        return Response(generate_lines(), mimetype='application/x-ndjson'), 200
 
-    for block in dict_chain:
-        block['transactions'] = [tx.__dict__.copy()
-                                 for tx in block['transactions']]
+    def generate_array():
+        separator = '['
+        for block in blocks:
+            yield separator + json.dumps(block.to_dict())
+            separator = ','
+        yield ']' if separator == ',' else '[]'
 
-    return jsonify(dict_chain), 200
+    return Response(generate_array(), mimetype='application/json'), 200
+
+
+@app.route('/chain/tip', methods=['GET'])
+def get_chain_tip():
+    tip_index = blockchain.height() - 1
+    response = {
+        'index': tip_index,
+        'hash': blockchain.get_block_hashes(tip_index, 1)[0]
+    }
+    return jsonify(response), 200
+
+
+@app.route('/chain/hashes', methods=['GET'])
+def get_chain_hashes():
+    start = max(request.args.get('from', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', SYNC_MAX_PAGE, type=int), 0), SYNC_MAX_PAGE)
+
+    return jsonify(blockchain.get_block_hashes(start, limit)), 200
+
+
+@app.route('/chain/<int:index>/proof/<tx_id>', methods=['GET'])
+def get_inclusion_proof(index, tx_id):
+    block = blockchain.block_at(index)
+    if block is None:
+        response = {'message': 'Block not found'}
+        return jsonify(response), 404
+    if block.merkle_root is None:
+        response = {'message': 'Block was mined without a merkle root'}
+        return jsonify(response), 400
+    tx_ids = [hash_transaction(tx) for tx in block.transactions]
+    if tx_id not in tx_ids:
+        response = {'message': 'Transaction not found in block'}
+        return jsonify(response), 404
+    # The header is enough to recompute the block hash, the proof links the transaction to the root
+    response = {
+        'header': {
+            'index': block.index,
+            'previous_hash': block.previous_hash,
+            'timestamp': block.timestamp,
+            'merkle_root': block.merkle_root,
+            'proof': block.proof
+        },
+        'hash': block.hash,
+        'tx_id': tx_id,
+        'merkle_proof': merkle_proof(tx_ids, tx_ids.index(tx_id))
+    }
+    return jsonify(response), 200
+
+
+@app.route('/tx/<tx_id>', methods=['GET'])
+def get_transaction(tx_id):
+    found = blockchain.get_transaction(tx_id)
+    if found is None:
+        response = {'message': 'Transaction not found'}
+        return jsonify(response), 404
+    transaction, block_index, position = found
+    response = {
+        'transaction': transaction.to_dict(),
+        'confirmed': block_index is not None,
+        'block_index': block_index,
+        'position': position,
+        'confirmations': 0 if block_index is None else blockchain.height() - block_index
+    }
+    return jsonify(response), 200
+
+
+@app.route('/address/<address>/transactions', methods=['GET'])
+def get_address_transactions(address):
+    start = max(request.args.get('from', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', ADDRESS_PAGE_SIZE, type=int), 0), ADDRESS_MAX_PAGE)
+    transactions, total = blockchain.get_address_transactions(address, start, limit)
+    response = {
+        'transactions': [{'transaction': tx.to_dict(), 'block_index': block_index, 'position': position}
+                         for tx, block_index, position in transactions],
+        'from': start,
+        'total': total
+    }
+    return jsonify(response), 200
 
 
 @app.route('/transaction', methods=['POST'])
@@ -188,6 +413,13 @@ def add_transaction():
     amount = req_body['amount']
 
     signature = wallet.sign_transaction(sender, recipient, amount)
+    if blockchain.has_open_transaction(Transaction(sender, recipient, signature, amount)):
+        response = {
+            'message': 'Duplicate transaction'
+        }
+
+        return jsonify(response), 409
+
     if blockchain.add_transaction(recipient, sender, signature, amount):
         response = {
             'message': 'Transaction added',
@@ -209,6 +441,37 @@ def add_transaction():
         return jsonify(response), 500
 
 
+@app.route('/transactions/batch', methods=['POST'])
+def add_transactions():
+    if wallet.public_key == None:
+        response = {
+            'message': 'No wallet setup'
+        }
+
+        return jsonify(response), 400
+
+    items, error = get_batch_items()
+    if error:
+        return error
+
+    sender = str(wallet.public_key).strip()
+
+    def to_transaction(values):
+        if not all(field in values for field in ['recipient', 'amount']):
+            return None
+        signature = wallet.sign_transaction(sender, values['recipient'], values['amount'])
+        return Transaction(sender, values['recipient'], signature, values['amount'])
+
+    results = add_batch(items, to_transaction, is_receiving=False)
+    added = sum(result['added'] for result in results)
+    response = {
+        'message': f'{added} of {len(results)} transactions added',
+        'results': results,
+        'funds': blockchain.get_balance()
+    }
+    return jsonify(response), 201 if added else 500
+
+
 @app.route('/resolve-conflicts', methods=['POST'])
 def resolve_conflicts():
     replaced = blockchain.resolve()
@@ -224,26 +487,33 @@ def mine():
     if blockchain.resolve_conflicts:
         response = {'message': 'Resolve conflicts first. Block not added'}
         return jsonify(response), 409
-    block = blockchain.mine_block()
-    if block != None:
-        dict_block = block.__dict__.copy()
-        dict_block['transactions'] = [tx.__dict__.copy()
-                                      for tx in dict_block['transactions']]
-
-        response = {
-            'message': 'Block added successfully',
-            'block': dict_block,
-            'funds': blockchain.get_balance()
-        }
-
-        return jsonify(response), 201
-    else:
+    if wallet.public_key == None:
         response = {
             'message': 'Adding a block failed',
-            'wallet_set_up': wallet.public_key != None
+            'wallet_set_up': False
         }
-
         return jsonify(response), 500
+    # The proof of work runs in the background, the job can be polled for its progress
+    job = blockchain.mining_jobs.submit()
+    response = {
+        'message': 'Mining job queued',
+        'job': blockchain.mining_jobs.status(job.id)
+    }
+    return jsonify(response), 202
+
+
+@app.route('/mine/<job_id>', methods=['GET'])
+def get_mining_job(job_id):
+    status = blockchain.mining_jobs.status(job_id)
+    if status is None:
+        response = {'message': 'Mining job not found'}
+        return jsonify(response), 404
+    response = {
+        'job': status,
+        'funds': blockchain.get_balance(),
+        'hash_rates': blockchain.miner.hash_rates
+    }
+    return jsonify(response), 200
 
 
 @app.route('/node', methods=['POST'])
@@ -288,11 +558,24 @@ def remove_node(node_url):
 @app.route('/node', methods=['GET'])
 def get_nodes():
     response = {
-        'all_nodes': blockchain.get_peer_nodes()
+        'all_nodes': blockchain.get_peer_nodes(),
+        'peers': blockchain.peers.stats()
     }
     return jsonify(response), 200
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4'), 200
+
+
+@app.route('/debug/profile', methods=['GET'])
+def get_profile():
+    top = min(max(request.args.get('top', PROFILE_TOP, type=int), 0), 500)
+    sort = request.args.get('sort', 'cumulative')
+    return jsonify(profiler.summary(top, sort)), 200
+
+
 @app.route('/network', methods=['GET'])
 def get_network_ui():
     return send_from_directory('ui', 'network.html')
@@ -307,8 +590,25 @@ if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=5000)
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of mining processes (defaults to the number of cores)')
+    parser.add_argument('--peer-connect-timeout', type=float, default=BROADCAST_TIMEOUT[0],
+                        help='Seconds to wait for a connection to a peer')
+    parser.add_argument('--peer-read-timeout', type=float, default=BROADCAST_TIMEOUT[1],
+                        help='Seconds to wait for a peer to send data')
+    parser.add_argument('--profile', action='store_true',
+                        help=f'Profile requests sending the {PROFILE_HEADER} header, see /debug/profile')
+    parser.add_argument('--profile-rate', type=float, default=0.0,
+                        help='Share of requests and mining runs profiled without being asked for, 0 to 1')
+    parser.add_argument('--profile-dir', default=None,
+                        help='Directory of the profile dumps (default: profiles-<port>)')
     args = parser.parse_args()
+    if args.profile or args.profile_rate > 0:
+        profiler.configure(args.profile_dir or f'profiles-{args.port}', args.profile_rate)
     port = args.port
+    mining_workers = args.workers
+    peer_timeout = (args.peer_connect_timeout, args.peer_read_timeout)
     wallet = Wallet(port)
-    blockchain = Blockchain(wallet.public_key, port)
-    app.run(host='0.0.0.0', port=port)
+    blockchain = Blockchain(wallet.public_key, port, mining_workers, peer_timeout)
+    # Requests are served in parallel, the blockchain serializes its changes itself
+    app.run(host='0.0.0.0', port=port, threaded=True)